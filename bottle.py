@@ -69,9 +69,11 @@ import base64
 import cgi
 import email.utils
 import functools
+import hashlib
 import hmac
 import inspect
 import itertools
+import marshal
 import mimetypes
 import os
 import re
@@ -80,11 +82,12 @@ import sys
 import thread
 import threading
 import time
+import zlib
 
-from Cookie import SimpleCookie
-from tempfile import TemporaryFile
+from Cookie import SimpleCookie, _unquote as cookie_unquote
+from tempfile import TemporaryFile, mkstemp
 from traceback import format_exc
-from urllib import quote as urlquote
+from urllib import quote as urlquote, unquote_plus as urlunquote
 from urlparse import urlunsplit, urljoin
 
 try:
@@ -97,34 +100,22 @@ try:
 except ImportError: # pragma: no cover
     from cgi import parse_qs
 
-try:
-    import cPickle as pickle
-except ImportError: # pragma: no cover
-    import pickle
-
 try:
     try:
-        from json import dumps as json_dumps
+        from json import dumps as json_dumps, loads as json_loads
     except ImportError: # pragma: no cover
-        from simplejson import dumps as json_dumps
+        from simplejson import dumps as json_dumps, loads as json_loads
 except ImportError: # pragma: no cover
-    json_dumps = None
+    json_dumps = json_loads = None
 
 if sys.version_info >= (3,0,0): # pragma: no cover
-    # See Request.POST
     from io import BytesIO
-    from io import TextIOWrapper
-    class NCTextIOWrapper(TextIOWrapper):
-        ''' Garbage collecting an io.TextIOWrapper(buffer) instance closes the
-            wrapped buffer. This subclass keeps it open. '''
-        def close(self): pass
     StringType = bytes
     def touni(x, enc='utf8'): # Convert anything to unicode (py3)
         return str(x, encoding=enc) if isinstance(x, bytes) else str(x)
 else:
     from StringIO import StringIO as BytesIO
     from types import StringType
-    NCTextIOWrapper = None
     def touni(x, enc='utf8'): # Convert anything to unicode (py2)
         return x if isinstance(x, unicode) else unicode(str(x), encoding=enc)
 
@@ -169,6 +160,12 @@ class HTTPError(HTTPResponse):
         return ''.join(ERROR_PAGE_TEMPLATE.render(e=self))
 
 
+class MultipartError(HTTPError):
+    """ The multipart/form-data request body could not be parsed """
+    def __init__(self, message):
+        super(MultipartError, self).__init__(400, message)
+
+
 
 
 
@@ -191,18 +188,28 @@ class Route(object):
     ''' Represents a single route and can parse the dynamic route syntax '''
     syntax = re.compile(r'(.*?)(?<!\\):([a-zA-Z_]+)?(?:#(.*?)#)?')
     default = '[^/]+'
+    filters = {'int':   (r'-?\d+', int, str),
+               'float': (r'-?\d*\.?\d+', float, repr),
+               'path':  (r'.+', None, None)}
 
-    def __init__(self, route, target, method='GET', name=None, static=False):
+    def __init__(self, route, target, method='GET', name=None, static=False,
+                 priority=0):
         """ Create a Route. The route string may contain `:key`,
             `:key#regexp#` or `:#regexp#` tokens for each dynamic part of the
             route. These can be escaped with a backslash infront of the `:`
             and are compleately ignored if static is true. A name may be used
-            to refer to this route later (depends on Router)
+            to refer to this route later (depends on Router). Dynamic routes
+            with a higher priority are tested first (depends on Router).
+
+            If the regexp of a `:key#regexp#` token is the name of a filter
+            (e.g. `:id#int#`, `:ratio#float#` or `:file#path#`), the filter
+            pattern is used and the value is converted (see add_filter()).
         """
         self.route = route
         self.method = method
         self.target = target
         self.name = name
+        self.priority = priority
         self._static = static
         self._tokens = None
 
@@ -212,15 +219,25 @@ class Route(object):
             self._tokens = list(self.tokenise(self.route))
         return self._tokens
 
+    @classmethod
+    def add_filter(cls, name, regexp, to_python=None, to_url=None):
+        ''' Register a named wildcard filter. Values matched by `regexp` are
+            converted by `to_python` before they are passed to the handler
+            and by `to_url` when URLs are built. '''
+        cls.filters[name] = (regexp, to_python, to_url)
+
     @classmethod
     def tokenise(cls, route):
-        ''' Split a string into an iterator of (type, value) tokens. '''
+        ''' Split a string into an iterator of (type, value) tokens. VAR
+            tokens have a (regexp, name, filter) value. '''
         match = None
         for match in cls.syntax.finditer(route):
             pre, name, rex = match.groups()
             if pre: yield ('TXT', pre.replace('\\:',':'))
-            if rex and name: yield ('VAR', (rex, name))
-            elif name: yield ('VAR', (cls.default, name))
+            if rex and name and rex in cls.filters:
+                yield ('VAR', (cls.filters[rex][0], name, rex))
+            elif rex and name: yield ('VAR', (rex, name, None))
+            elif name: yield ('VAR', (cls.default, name, None))
             elif rex: yield ('ANON', rex)
         if not match:
             yield ('TXT', route.replace('\\:',':'))
@@ -241,6 +258,11 @@ class Route(object):
         rf = lambda m: m.group(0) if len(m.group(1)) % 2 else m.group(1) + '(?:'
         return re.sub(r'(\\*)(\(\?P<[^>]*>|\((?!\?))', rf, self.group_re())
 
+    def converters(self):
+        ''' Return a tuple of (name, filter) pairs for filtered wildcards '''
+        return tuple((value[1], value[2]) for token, value in self.tokens()
+                     if token == 'VAR' and value[2])
+
     def format_str(self):
         ''' Return a format string with named fields. '''
         if self.static:
@@ -281,67 +303,452 @@ class Router(object):
         Some dynamic routes may extract parts of the string and provide them as
         a dictionary. This router matches a string against multiple routes and
         returns the associated object along with the extracted data.
+
+        Dynamic routes are not tested one by one. They are merged into a small
+        number of large alternation regexps (see compile()), so that most
+        requests are dispatched with a single regexp call.
+
+        Static routes are always tested first. Dynamic routes are tested by
+        priority (highest first) and declaration order. The first matching
+        route with a handler for the request method wins.
+
+        Routes are compiled lazily on first use. If `cachefile` is given, the
+        compiled lookup table is stored in that file and reused on the next
+        start as long as the route definitions did not change.
     '''
+    max_groups = 99 # Python 2.x re supports no more than 100 groups per regexp
+    table_format = 4 # Change this if the layout of the lookup table changes
 
-    def __init__(self):
+    def __init__(self, cachefile=None):
+        self.version = 0     # Incremented on every change. Used by caches.
+        self.cachefile = cachefile
         self.routes = []     # List of all installed routes
         self.static = dict() # Cache for static routes
-        self.dynamic = dict()  # Cache structure for dynamic routes
-        self.named = dict()  # Cache for named routes and their format strings
+        self.dynamic = None  # List of (combined regexp, {lastindex: route entry})
+        self.named = dict()  # Mapping of route names to route tokens
+        self.builders = dict() # Cache for compiled URL builders (see builder())
+        self.lock = threading.Lock() # Serializes compile()
 
     def add(self, *a, **ka):
         """ Adds a route->target pair or a Route object to the Router.
             See Route() for details.
         """
         route = a[0] if a and isinstance(a[0], Route) else Route(*a, **ka)
+        self.version += 1
         self.routes.append(route)
-        if route.name:
-            self.named[route.name] = route.format_str()
-        if route.static:
-            self.static[route.route] = self.static.get(route.route, {})
-            if self.static[route.route].has_key(route.method):
-                print "WARNING: overridding definition %s %s -> %s" % (route.method, route.route, route.target.__name__)
-            self.static[route.route][route.method] =  (route.target, None)
-            return
-        try:
-            gpatt = route.group_re()
-            fpatt = re.compile('(^%s$)'% route.flat_re())
-            gregexp = re.compile('^(%s)$' % gpatt) if '(?P' in gpatt else None
-            
-            self.dynamic[fpatt] = self.dynamic.get(fpatt, {})
-            if self.dynamic[fpatt].has_key(route.method):
-                print "WARNING: overridding definition %s %s -> %s" % (route.method, route.route, route.target.__name__)
-            self.dynamic[fpatt][route.method] = (route.target, gregexp)
-        except re.error, e:
-            raise RouteSyntaxError("Could not add Route: %s (%s)" % (route, e))
-
-
-    def match(self, uri):
-        ''' Matches an URL and returns a list of (method, handler, params) tuples '''
-        matched_routes = []
-        
-        suri = self.static.get(uri)
-        if suri:
-            matched_routes.append(suri)
-
-        for patt in self.dynamic:
-            match = patt.match(uri)
+        self.dynamic = None
+
+    def compile(self):
+        ''' Compile all routes. This is done automatically on first use.
+            Raises RouteSyntaxError on invalid route patterns. '''
+        with self.lock:
+            self._compile()
+
+    def _compile(self):
+        key = self.table_key()
+        table = None
+        if self.cachefile and os.path.exists(self.cachefile):
+            try:
+                with open(self.cachefile, 'rb') as fp:
+                    table = marshal.load(fp)
+                if table.get('key') != key: table = None
+            except (EOFError, ValueError, TypeError, AttributeError):
+                table = None
+        if table is None:
+            table = self._build_table()
+            table['key'] = key
+            if self.cachefile:
+                try:
+                    fd, tmp = mkstemp('.tmp', '', os.path.dirname(
+                                      os.path.abspath(self.cachefile)))
+                    with os.fdopen(fd, 'wb') as fp:
+                        marshal.dump(table, fp)
+                    os.rename(tmp, self.cachefile)
+                except (IOError, OSError), e:
+                    print "WARNING: could not write route cache: %s" % e
+        self._link(table)
+
+    def table_key(self):
+        ''' A hash of all route definitions and filters used as a cache key. '''
+        routes = [(r.route, r.method, r.name, r._static, r.priority) for r in self.routes]
+        filters = sorted((k, v[0]) for k, v in Route.filters.iteritems())
+        data = repr((self.__class__.__name__, __version__, self.table_format,
+                     routes, filters))
+        return hashlib.sha1(tob(data)).hexdigest()
+
+    def _build_table(self):
+        ''' Build a serializable lookup table. Targets are stored as indices
+            into self.routes and resolved by _link(). '''
+        table = {'static': {}, 'named': {}, 'patterns': {}}
+        for index, route in enumerate(self.routes):
+            if route.name:
+                table['named'][route.name] = route.tokens()
+            if route.static:
+                targets = table['static'].setdefault(route.route, {})
+            else:
+                targets = self._add_dynamic(table, route, index)
+            if route.method in targets:
+                print "WARNING: overridding definition %s %s -> %s" % (route.method,
+                      route.route, getattr(route.target, '__name__', route.target))
+            targets[route.method] = index
+        table['dynamic'] = self._combine(table.pop('patterns').values())
+        return table
+
+    def _add_dynamic(self, table, route, index):
+        ''' Add a dynamic route to the table and return its method->index dict. '''
+        pattern, converters = route.group_re(), route.converters()
+        entry = table['patterns'].get((pattern, converters))
+        if not entry:
+            try:
+                compiled = re.compile('^(?:%s)$' % pattern)
+            except re.error, e:
+                raise RouteSyntaxError("Could not add Route: %s (%s)" % (route, e))
+            entry = [route.priority, index, pattern, bool(compiled.groupindex),
+                     {}, converters]
+            table['patterns'][(pattern, converters)] = entry
+        entry[0] = max(entry[0], route.priority)
+        return entry[4]
+
+    def _combine(self, entries):
+        ''' Merge dynamic routes into as few alternation regexps as possible.
+            All groups of a route are made non-capturing and a single group
+            per route is used to identify the matching route via
+            `match.lastindex`, so that each regexp holds up to `max_groups`
+            routes. Arguments are extracted with the own regexp of the
+            matching route afterwards, if it has any.
+
+            Routes are ordered by priority and declaration order. Routes that
+            can never match because an identical pattern was defined earlier
+            are reported here, once. '''
+        dynamic, parts, lookup, seen = [], [], {}, {}
+        flat = lambda m: m.group(0) if len(m.group(1)) % 2 else m.group(1) + '(?:'
+        entries = sorted(entries, key=lambda e: (-e[0], e[1]))
+        for priority, index, pattern, has_args, targets, converters in entries:
+            if len(parts) == self.max_groups:
+                dynamic.append(('^(?:%s)$' % '|'.join(parts), lookup))
+                parts, lookup = [], {}
+            plain = re.sub(r'(\\*)(\(\?P<[^>]*>|\((?!\?))', flat, pattern)
+            other, methods = seen.setdefault(plain, (pattern, set()))
+            if methods & set(targets) or 'ANY' in methods:
+                print "WARNING: route pattern %s is shadowed by %s" % (pattern, other)
+            methods.update(targets)
+            parts.append('(%s)' % plain)
+            lookup[len(parts)] = (targets, pattern, has_args, converters,
+                                  (-priority, index))
+        if parts:
+            dynamic.append(('^(?:%s)$' % '|'.join(parts), lookup))
+        return dynamic
+
+    def _link(self, table):
+        ''' Resolve targets and filters and compile the combined regexps.
+            The regexps of single routes are compiled on first use (see
+            _route_re()). self.dynamic is assigned last, because match() uses
+            it to tell whether the router is compiled. '''
+        dynamic = [(re.compile(pattern), dict((i, [self._targets(targets),
+                   pattern, has_args, self._converters(conv), tuple(order), None])
+                   for i, (targets, pattern, has_args, conv, order)
+                   in lookup.iteritems())) for pattern, lookup in table['dynamic']]
+        self.static = dict((path, self._targets(targets))
+                           for path, targets in table['static'].iteritems())
+        self.named = table['named']
+        self.builders = dict()
+        self.dynamic = dynamic
+
+    def _targets(self, targets):
+        return MethodMap((method, self.routes[index].target)
+                         for method, index in targets.iteritems())
+
+    def _converters(self, converters):
+        ''' Turn (name, filter) pairs into (name, to_python) pairs. '''
+        return tuple((name, Route.filters[f][1]) for name, f in converters
+                     if Route.filters[f][1])
+
+    def match(self, uri, method=None):
+        ''' Matches an URL and returns a (targets, params) tuple. Targets is a
+            :class:`MethodMap` of method->handler pairs or None if nothing
+            matched. If `method` is given, routes without a handler for this
+            method are skipped. If no matching route has one, the first
+            matching route is returned (see :meth:`allowed`).
+        '''
+        if self.dynamic is None:
+            self.compile()
+        targets = self.static.get(uri)
+        if targets and (method is None or targets[method]):
+            return targets, {}
+        found = [None, None]
+        self._match_dynamic(uri, method, found)
+        if found[0]:
+            return found[0][1:]
+        if targets:
+            return targets, {}
+        return found[1][1:] if found[1] else (None, {})
+
+    def allowed(self, uri):
+        ''' Return a sorted list of the methods accepted by any route matching
+            `uri` (for Allow headers). All routes are tested, so this is slow
+            and should be used for 405 and OPTIONS responses only. '''
+        if self.dynamic is None:
+            self.compile()
+        allowed = set(['OPTIONS'])
+        for targets in self._match_all(uri):
+            allowed.update(targets)
+        allowed.discard('ANY')
+        return sorted(allowed)
+
+    def _match_all(self, uri):
+        ''' Return the targets of all routes matching `uri`. '''
+        matches = [self.static[uri]] if uri in self.static else []
+        matches.extend(entry[0] for entry in self._candidates(uri))
+        return matches
+
+    def _match_dynamic(self, uri, method, found):
+        self._match_regexp(uri, method, found)
+
+    def _match_regexp(self, uri, method, found):
+        ''' Test the dynamic routes in order. The first match with a handler
+            for `method` is stored in found[0], the first match at all in
+            found[1], both as (order, targets, args) tuples. Order is
+            (-priority, declaration index). Routes that come after found[0]
+            are not tested. '''
+        for entry in self._candidates(uri):
+            targets, order = entry[0], entry[4]
+            if found[0] and order >= found[0][0]:
+                return
+            accept = method is None or targets[method]
+            first = not found[1] or order < found[1][0]
+            if not (accept or first):
+                continue
+            result = order, targets, self._args(entry, uri)
+            if first:
+                found[1] = result
+            if accept:
+                found[0] = result
+                return
+
+    def _candidates(self, uri):
+        ''' Yield the entries of all dynamic routes matching `uri` in order.
+            A combined regexp only finds the first match in its block. The
+            remaining routes of that block are tested one by one, but only if
+            the caller asks for the next match. '''
+        for combined, lookup in self.dynamic:
+            match = combined.match(uri)
             if not match: continue
-            matched_routes.append(self.dynamic[patt])
-            
-        return matched_routes
+            yield lookup[match.lastindex]
+            for i in xrange(match.lastindex + 1, len(lookup) + 1):
+                if self._route_re(lookup[i])(uri):
+                    yield lookup[i]
+
+    def _args(self, entry, uri):
+        ''' Extract and convert the arguments of a matching dynamic route. '''
+        args = self._route_re(entry)(uri).groupdict() if entry[2] else {}
+        try:
+            for name, func in entry[3]:
+                args[name] = func(args[name])
+        except ValueError:
+            raise HTTPError(400, "Wrong format for parameter %s: %s" % (name, uri))
+        return args
+
+    def _route_re(self, entry):
+        ''' Return the match function of a single dynamic route. Entries are
+            [targets, pattern, has_args, converters, order, match function]
+            lists and the pattern is compiled the first time it is needed. '''
+        if entry[5] is None:
+            entry[5] = re.compile('^(?:%s)$' % entry[1]).match
+        return entry[5]
+
+    def builder(self, route_name):
+        ''' Return a compiled URL builder for a named route. The builder is a
+            function that takes a dict of parameters and returns the URL.
+            Parameters are converted by their filter (if any), checked
+            against the wildcard pattern and quoted. '''
+        if self.dynamic is None:
+            self.compile()
+        builder = self.builders.get(route_name)
+        if not builder:
+            if route_name not in self.named:
+                raise RouteBuildError("No route found with name '%s'." % route_name)
+            builder = self._compile_builder(route_name, self.named[route_name])
+            self.builders[route_name] = builder
+        return builder
+
+    def _compile_builder(self, route_name, tokens):
+        fmt, parts, anon = '', [], 0
+        for token, value in tokens:
+            if token == 'TXT':
+                fmt += value.replace('%', '%%')
+                continue
+            if token == 'ANON':
+                rex, name, filt = value, 'anon%d' % anon, None
+                anon += 1
+            else:
+                rex, name, filt = value
+            fmt += '%s'
+            parts.append((name, self._compile_part(route_name, name, rex, filt)))
+        def builder(args):
+            try:
+                return fmt % tuple([part(args[name]) for name, part in parts])
+            except KeyError, e:
+                raise RouteBuildError("Missing parameter '%s' in route '%s'"
+                                      % (e.args[0], route_name))
+        return builder
+
+    def _compile_part(self, route_name, name, rex, filt):
+        to_url = Route.filters[filt][2] if filt else None
+        check = re.compile('^(?:%s)$' % rex).match
+        def part(value):
+            if to_url: value = to_url(value)
+            value = value.encode('utf8') if isinstance(value, unicode) else str(value)
+            if not check(value):
+                raise RouteBuildError("Parameter '%s' does not match pattern for"
+                                      " route '%s': '%s'" % (name, route_name, rex))
+            return urlquote(value, '/')
+        return part
 
     def build(self, route_name, **args):
         ''' Builds an URL out of a named route and some parameters.'''
-        try:
-            return self.named[route_name] % args
-        except KeyError:
-            raise RouteBuildError("No route found with name '%s'." % route_name)
+        return self.builder(route_name)(args)
+
+    def build_all(self, route_name, args_list):
+        ''' Builds a list of URLs for a named route, one for each dict of
+            parameters in `args_list`. '''
+        builder = self.builder(route_name)
+        return [builder(args) for args in args_list]
 
     def __eq__(self, other):
         return self.routes == other.routes
 
 
+class RadixRouter(Router):
+    ''' A Router that stores dynamic routes in a prefix tree of path segments.
+
+        Static segments are resolved with a dict lookup per segment and plain
+        `:name` wildcards (which match a whole segment) are captured without
+        any regexp. Lookup cost depends on the depth of the path, not on the
+        number of routes. Routes with custom `#regexp#` tokens, wildcards
+        that do not span a whole segment or a non-zero priority (and all
+        routes with the same pattern) fall back to the regexp based matching
+        of :class:`Router`.
+
+        Routes are matched in the same order as by :class:`Router`: If several
+        routes match, the one with the highest priority and then the earliest
+        declaration wins, regardless of static or wildcard segments.
+    '''
+
+    def __init__(self, cachefile=None):
+        Router.__init__(self, cachefile)
+        self.tree = [{}, None, None, None] # [static children, wildcard, leaf, min order]
+        self.regexp_min = None # Order of the first regexp based route
+
+    def _build_table(self):
+        # Routes sharing a pattern with a prioritized route must share its
+        # regexp entry, so that later definitions override earlier ones.
+        self._prioritized = set(self._pattern(r) for r in self.routes
+                                if r.priority and not r.static)
+        self._tree = [{}, None, None]
+        table = Router._build_table(self)
+        table['tree'], self._tree, self._prioritized = self._tree, None, None
+        return table
+
+    def _pattern(self, route):
+        return route.group_re(), route.converters()
+
+    def _add_dynamic(self, table, route, index):
+        if self._prioritized and self._pattern(route) in self._prioritized:
+            return Router._add_dynamic(self, table, route, index)
+        segments = []
+        for segment in route.route.split('/'):
+            tokens = list(route.tokenise(segment)) if segment else [('TXT', '')]
+            if len(tokens) != 1:
+                return Router._add_dynamic(self, table, route, index)
+            token, value = tokens[0]
+            if token == 'TXT':
+                segments.append((value, None))
+            elif token == 'VAR' and value[0] == route.default and not value[2]:
+                segments.append((None, value[1]))
+            else:
+                return Router._add_dynamic(self, table, route, index)
+        node, names = self._tree, []
+        for text, name in segments:
+            if name is None:
+                node = node[0].setdefault(text, [{}, None, None])
+            else:
+                node[1] = node[1] or [{}, None, None]
+                node = node[1]
+                names.append(name)
+        names = tuple(names)
+        if node[2] is None:
+            node[2] = ({}, names, index)
+        elif node[2][1] != names: # Same shape, different names. Use a regexp.
+            return Router._add_dynamic(self, table, route, index)
+        return node[2][0]
+
+    def _link(self, table):
+        orders = [entry[4] for combined, lookup in table['dynamic']
+                           for entry in lookup.itervalues()]
+        self.regexp_min = tuple(min(orders)) if orders else None
+        self.tree = self._link_node(table['tree'])
+        Router._link(self, table)
+
+    def _link_node(self, node):
+        ''' Resolve targets and store the lowest route order of each subtree,
+            so that _walk() can skip subtrees that cannot win. '''
+        children, wildcard, leaf = node
+        children = dict((k, self._link_node(v)) for k, v in children.iteritems())
+        wildcard = wildcard and self._link_node(wildcard)
+        leaf = leaf and (self._targets(leaf[0]), tuple(leaf[1]), (0, leaf[2]))
+        orders = [child[3] for child in children.values()]
+        if wildcard: orders.append(wildcard[3])
+        if leaf: orders.append(leaf[2])
+        return [children, wildcard, leaf, min(orders) if orders else None]
+
+    def _match_dynamic(self, uri, method, found):
+        self._walk(self.tree, uri.split('/'), 0, [], method, found)
+        if self.regexp_min is not None and (not found[0] or self.regexp_min < found[0][0]):
+            self._match_regexp(uri, method, found)
+
+    def _walk(self, node, parts, depth, values, method, found):
+        ''' Depth-first search for matching leafs. Stores results in `found`
+            the same way as :meth:`Router._match_regexp` does. '''
+        if node[3] is None or (found[0] and node[3] >= found[0][0]):
+            return
+        if depth == len(parts):
+            leaf = node[2]
+            if not leaf: return
+            accept = method is None or leaf[0][method]
+            first = not found[1] or leaf[2] < found[1][0]
+            if accept or first:
+                result = leaf[2], leaf[0], dict(zip(leaf[1], values))
+                if first:
+                    found[1] = result
+                if accept and (not found[0] or leaf[2] < found[0][0]):
+                    found[0] = result
+            return
+        part = parts[depth]
+        child = node[0].get(part)
+        if child:
+            self._walk(child, parts, depth + 1, values, method, found)
+        if part and node[1]:
+            values.append(part)
+            self._walk(node[1], parts, depth + 1, values, method, found)
+            values.pop()
+
+    def _match_all(self, uri):
+        matches = Router._match_all(self, uri)
+        self._collect(self.tree, uri.split('/'), 0, matches)
+        return matches
+
+    def _collect(self, node, parts, depth, matches):
+        ''' Append the targets of all leafs matching `parts` to `matches`. '''
+        if depth == len(parts):
+            if node[2]: matches.append(node[2][0])
+            return
+        child = node[0].get(parts[depth])
+        if child:
+            self._collect(child, parts, depth + 1, matches)
+        if parts[depth] and node[1]:
+            self._collect(node[1], parts, depth + 1, matches)
+
+
 
 
 
@@ -351,12 +758,22 @@ class Router(object):
 class Bottle(object):
     """ WSGI application """
 
-    def __init__(self, catchall=True, autojson=True, config=None):
+    def __init__(self, catchall=True, autojson=True, config=None, router=None,
+                 match_cache=0, cache_store=None):
         """ Create a new bottle instance.
             You usually don't do that. Use `bottle.app.push()` instead.
+            A custom :class:`Router` instance (e.g. a :class:`RadixRouter`)
+            may be passed as `router`. If `match_cache` is a positive number,
+            up to that many results of :meth:`match_url` are cached.
+            Responses of routes decorated with :func:`cache` are stored in
+            `cache_store` (default: a new :class:`MemoryCacheStore`).
         """
-        self.routes = Router()
+        self.routes = router or Router()
+        self.match_cache = LRUCache(match_cache) if match_cache else None
+        self.cache_store = cache_store or MemoryCacheStore()
+        self.match_cache_version = self.routes.version
         self.mounts = {}
+        self.mount_depths = []
         self.error_handler = {}
         self.catchall = catchall
         self.config = config or {}
@@ -365,22 +782,46 @@ class Bottle(object):
         if autojson and json_dumps:
             self.add_filter(dict, dict2json)
 
-    def mount(self, app, script_path):
-        ''' Mount a Bottle application to a specific URL prefix '''
+    def mount(self, app, script_path, flatten=False):
+        ''' Mount a Bottle application to a specific URL prefix.
+
+            Requests to mounted applications are dispatched before the router
+            is asked. If `flatten` is true, the routes of `app` are copied
+            into this application instead. Routes added to `app` later are
+            not copied and the handlers see the full request path. '''
         if not isinstance(app, Bottle):
             raise TypeError('Only Bottle instances are supported for now.')
         script_path = '/'.join(filter(None, script_path.split('/')))
-        path_depth = script_path.count('/') + 1
         if not script_path:
             raise TypeError('Empty script_path. Perhaps you want a merge()?')
+        if flatten:
+            prefix = script_path.replace(':', '\\:') + '/'
+            for r in app.routes.routes:
+                self.routes.add(prefix + r.route.lstrip('/'), r.target, r.method,
+                                name=r.name, static=r._static, priority=r.priority)
+            return
         for other in self.mounts:
             if other.startswith(script_path):
                 raise TypeError('Conflict with existing mount: %s' % other)
-        @self.route('/%s/:#.*#' % script_path, method="ANY")
-        def mountpoint():
-            request.path_shift(path_depth)
-            return app.handle(request.path, request.method)
         self.mounts[script_path] = app
+        self.mount_depths = sorted(set(p.count('/') + 1 for p in self.mounts))
+
+    def _match_mount(self, url):
+        ''' Return the application mounted for this URL or None. SCRIPT_NAME
+            and PATH_INFO are adjusted to the mount point. '''
+        path = url.lstrip('/')
+        for depth in self.mount_depths:
+            parts = path.split('/', depth)
+            if len(parts) <= depth:
+                return None
+            app = self.mounts.get('/'.join(parts[:depth]))
+            if app:
+                env = request.environ
+                script_name = env.get('SCRIPT_NAME', '').rstrip('/')
+                env['SCRIPT_NAME'] = script_name + '/' + '/'.join(parts[:depth])
+                env['PATH_INFO'] = request.path = '/' + parts[depth]
+                return app
+        return None
 
     def add_filter(self, ftype, func):
         ''' Register a new output filter. Whenever bottle hits a handler output
@@ -395,33 +836,52 @@ class Bottle(object):
         """ Find a callback bound to a path and a specific HTTP method.
             Return (callback, param) tuple or (None, {}).
             method: HEAD falls back to GET. All methods fall back to ANY.
+            OPTIONS requests are answered automatically if no route matching
+            the path defines OPTIONS or ANY.
+
+            If the match cache is enabled, results (including 404 and 405
+            errors) are cached until the next change to the router.
         """
+        cache = self.match_cache
+        if cache is None:
+            return self._match_url(path, method)
+        if self.match_cache_version != self.routes.version:
+            cache.clear()
+            self.match_cache_version = self.routes.version
+        result = cache.get((path, method))
+        if result is None:
+            try:
+                result = cache[(path, method)] = self._match_url(path, method)
+            except HTTPError, e:
+                result = cache[(path, method)] = (None, (e.status, e.output, e.headers))
+        if result[0] is None:
+            raise HTTPError(result[1][0], result[1][1], header=result[1][2])
+        return result
+
+    def _match_url(self, path, method):
         rpath = path.strip().lstrip('/')
-        uri_matches = self.routes.match(rpath)
-        if not uri_matches:
+        targets, args = self.routes.match(rpath, method)
+        if not targets:
             raise HTTPError(404, "Not found:" + path)
-        matches = []
-        for m in uri_matches:
-            r = m.get(method) or (m.get('GET') if method == 'HEAD' else None) or m.get('ANY')
-            if r:
-                matches.append(r)
-        if not matches:
-            allowed_methods = []
-            for m in uri_matches:
-                allowed_methods.extend(m.keys())
-            raise HTTPError(405, "Method Not Allowed on %s (%s)" % (path, method), header={'Allow': ', '.join(set(allowed_methods))})
-        else:
-            if len(matches) > 1:
-                print "WARN: Multiple matches found for uri %s method %s" % (path, method)
-            handler, groupregexp = matches[0]
-            return (handler, groupregexp.match(rpath).groupdict() if groupregexp else {})
+        handler = targets[method]
+        if not handler:
+            allow = {'Allow': ', '.join(self.routes.allowed(rpath))}
+            if method != 'OPTIONS':
+                raise HTTPError(405, "Method Not Allowed on %s (%s)" % (path, method), header=allow)
+            handler = lambda **args: HTTPResponse(header=allow)
+        return handler, args
 
 
     def get_url(self, routename, **kargs):
         """ Return a string that matches a named route """
         return '/' + self.routes.build(routename, **kargs)
 
-    def route(self, path=None, method='GET', **kargs):
+    def get_urls(self, routename, args_list):
+        """ Return a list of URLs for a named route, one for each dict of
+            parameters in `args_list`. """
+        return ['/' + url for url in self.routes.build_all(routename, args_list)]
+
+    def route(self, path=None, method='GET', callback=None, **kargs):
         """ Decorator: Bind a function to a GET request path.
 
             If the path parameter is None, the signature of the decorated
@@ -430,10 +890,16 @@ class Bottle(object):
 
             The method parameter (default: GET) specifies the HTTP request
             method to listen to. You can specify a list of methods. 
+
+            If a callback is given, it is bound directly instead of returning
+            a decorator. The callback may be a 'module:function' string. It
+            is imported on the first request (see :class:`LazyHandler`).
         """
         if isinstance(method, str): #TODO: Test this
             method = method.split(';')
         def wrapper(callback):
+            if isinstance(callback, basestring) and ':' in callback:
+                callback = LazyHandler(callback)
             paths = [] if path is None else [path.strip().lstrip('/')]
             if not paths: # Lets generate the path automatically 
                 paths = yieldroutes(callback)
@@ -441,7 +907,18 @@ class Bottle(object):
                 for m in method:
                     self.routes.add(p, callback, m.upper(), **kargs)
             return callback
-        return wrapper
+        return wrapper(callback) if callback else wrapper
+
+    def load_routes(self, table):
+        """ Bind many routes at once. `table` is an iterable of
+            (path, method, target) or (path, method, target, options) rows.
+            Targets may be 'module:function' strings (see :meth:`route`), so
+            large route maps can be loaded without importing handler code.
+            Options is a dict of additional keyword arguments for
+            :meth:`route` (e.g. name or priority). """
+        for row in table:
+            options = row[3] if len(row) > 3 else {}
+            self.route(row[0], row[1], row[2], **options)
 
     def get(self, path=None, method='GET', **kargs):
         """ Decorator: Bind a function to a GET request path.
@@ -478,8 +955,33 @@ class Bottle(object):
             return HTTPError(503, "Server stopped")
 
         try:
+            if self.mounts:
+                app = self._match_mount(url)
+                if app:
+                    return app.handle(request.path, method)
             handler, args = self.match_url(url, method)
-
+            options = getattr(handler, '_bottle_options', None) or {}
+            limits = options.get('limits')
+            if limits:
+                request.environ['bottle.limits'] = limits
+            compress_options = options.get('compress')
+            if compress_options is not None:
+                request.environ['bottle.compress'] = compress_options
+            etag_func = options.get('etag')
+            if etag_func is not None and request.method in ('GET', 'HEAD'):
+                tag = etag_func(**args)
+                if tag is not None:
+                    tag = response.headers['ETag'] = format_etag(tag)
+                    if etag_match(request.header.get('If-None-Match', ''), tag):
+                        return HTTPResponse(status=304)
+            cache_options = options.get('cache')
+            if cache_options is not None and request.method in ('GET', 'HEAD'):
+                cached = self._cache_get(cache_options)
+                if cached is not None:
+                    return cached
+            max_body_size = request.get_limit('max_body_size')
+            if max_body_size is not None and request.content_length > max_body_size:
+                return HTTPError(413, 'Request entity too large.')
             return handler(**args)
         except HTTPResponse, e:
             return e
@@ -553,14 +1055,110 @@ class Bottle(object):
         return self._cast(HTTPError(500, 'Unsupported response type: %s'\
                                          % type(first)), request, response)
 
+    def _cache_get(self, options):
+        """ Return a cached response for the current request as HTTPResponse,
+        or remember where to store the response and return None. The stored
+        headers are applied to the response directly, so that repeated
+        headers (e.g. Link) are restored. """
+        key = cache_key(request, options['vary'])
+        entry = self.cache_store.get(key)
+        if entry is not None:
+            if entry[1] > time.time():
+                seen = set()
+                for name, value in entry[3]:
+                    if name in seen:
+                        response.headers.append(name, value)
+                    else:
+                        response.headers[name] = value
+                        seen.add(name)
+                return HTTPResponse(entry[4], entry[2])
+            self.cache_store.delete(key)
+        request.environ['bottle.cache'] = (self.cache_store, key, options['ttl'])
+
+    def _cache_set(self, out, request, response):
+        """ Store the output of :meth:`_cast` in the response cache. Only
+        materialized 200 responses without cookies are stored. """
+        store, key, ttl = request.environ.pop('bottle.cache')
+        cache_control = response.headers.get('Cache-Control', '')
+        if response.status != 200 or not isinstance(out, list) or response._COOKIES\
+        or 'Set-Cookie' in response.headers or 'no-store' in cache_control\
+        or 'private' in cache_control:
+            return out
+        headers = [(name, value) for name, value in response.headers.iterallitems()
+                   if name != 'Content-Length']
+        body = tob('').join(out)
+        store.set(key, (key, time.time() + ttl, response.status, headers, body))
+        return out
+
+    def _etag(self, out, request, response):
+        """ If enabled (config 'etag'), add a weak ETag to materialized 200
+        responses to GET and HEAD requests and answer matching If-None-Match
+        requests with 304 Not Modified. """
+        if not self.config.get('etag') or response.status != 200\
+        or request.method not in ('GET', 'HEAD') or not isinstance(out, list)\
+        or 'ETag' in response.headers:
+            return out
+        body = out[0] if len(out) == 1 else tob('').join(out)
+        tag = 'W/"%x-%x"' % (len(body), zlib.crc32(body) & 0xffffffff)
+        response.headers['ETag'] = tag
+        if etag_match(request.header.get('If-None-Match', ''), tag):
+            response.status = 304
+            return []
+        return out
+
+    def _compress(self, out, request, response):
+        """ Compress the output of :meth:`_cast` with gzip or deflate, if
+        enabled for the app (config 'compress') or route (see :func:`compress`)
+        and accepted by the client. Only bodies of at least 'compress_min_size'
+        bytes (if the size is known) and content types in 'compress_types'
+        are compressed. Iterables are compressed incrementally. """
+        options = request.environ.get('bottle.compress') or {}
+        if not options.get('enable', self.config.get('compress')):
+            return out
+        if response.status in (100, 101, 204, 304)\
+        or 'Content-Encoding' in response.headers:
+            return out
+        ctype = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if not ctype.startswith(self.config.get('compress_types', COMPRESS_TYPES)):
+            return out
+        vary = response.headers.get('Vary')
+        if not vary:
+            response.headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            response.headers['Vary'] = vary + ', Accept-Encoding'
+        encoding = accept_encoding(request.header.get('Accept-Encoding', ''))
+        if not encoding:
+            return out
+        size = int(response.headers.get('Content-Length', -1))
+        if 0 <= size < options.get('min_size', self.config.get('compress_min_size', 500)):
+            return out
+        level = options.get('level', self.config.get('compress_level', 6))
+        wbits = zlib.MAX_WBITS | 16 if encoding == 'gzip' else zlib.MAX_WBITS
+        compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        response.headers['Content-Encoding'] = encoding
+        if isinstance(out, list):
+            out = compressor.compress(tob('').join(out)) + compressor.flush()
+            response.headers['Content-Length'] = str(len(out))
+            return [out]
+        if 'Content-Length' in response.headers:
+            del response.headers['Content-Length']
+        return compress_iter(out, compressor)
+
     def __call__(self, environ, start_response):
         """ The bottle WSGI-interface. """
         try:
             environ['bottle.app'] = self
-            request.bind(environ)
+            request.bind(environ, self.config)
             response.bind(self)
             out = self.handle(request.path, request.method)
             out = self._cast(out, request, response)
+            if 'bottle.cache' in request.environ:
+                out = self._cache_set(out, request, response)
+            out = self._etag(out, request, response)
+            out = self._compress(out, request, response)
+            if response.status == 304:
+                for name in ('Content-Type', 'Content-Length'):
+                    if name in response.headers: del response.headers[name]
             if response.status in (100, 101, 204, 304) or request.method == 'HEAD':
                 out = [] # rfc2616 section 4.3
             status = '%d %s' % (response.status, HTTP_CODES[response.status])
@@ -591,7 +1189,7 @@ class Request(threading.local, DictMixin):
             You usually don't do this but use the global `bottle.request`
             instance instead.
         """
-        self.bind(environ or {}, config)
+        self.bind({} if environ is None else environ, config)
 
     def bind(self, environ, config=None):
         """ Bind a new WSGI enviroment.
@@ -606,8 +1204,10 @@ class Request(threading.local, DictMixin):
         self.method = environ.get('REQUEST_METHOD', 'GET').upper()
 
     def copy(self):
-        ''' Returns a copy of self '''
-        return Request(self.environ.copy(), self.config)
+        ''' Returns a copy of self. The copy shares unchanged environ entries
+            (and cached values) with the original (see :class:`EnvironOverlay`).
+        '''
+        return Request(EnvironOverlay(self.environ), self.config)
         
     def path_shift(self, shift=1):
         ''' Shift path fragments from PATH_INFO to SCRIPT_NAME and vice versa.
@@ -630,7 +1230,7 @@ class Request(threading.local, DictMixin):
         todelete = []
         if key in ('PATH_INFO','REQUEST_METHOD'):
             self.bind(self.environ, self.config)
-        elif key == 'wsgi.input': todelete = ('body','forms','files','params')
+        elif key == 'wsgi.input': todelete = ('body','forms','files','params','json')
         elif key == 'QUERY_STRING': todelete = ('get','params')
         elif key.startswith('HTTP_'): todelete = ('headers', 'cookies')
         for key in todelete:
@@ -671,31 +1271,25 @@ class Request(threading.local, DictMixin):
 
     @property
     def header(self):
-        ''' :class:`HeaderDict` filled with request headers.
+        ''' A read-only :class:`WSGIHeaderDict` view of the request headers.
 
-            HeaderDict keys are case insensitive str.title()d 
+            Keys are case insensitive and str.title()d on iteration.
         '''
         if 'bottle.headers' not in self.environ:
-            header = self.environ['bottle.headers'] = HeaderDict()
-            for key, value in self.environ.iteritems():
-                if key.startswith('HTTP_'):
-                    key = key[5:].replace('_','-').title()
-                    header[key] = value
+            self.environ['bottle.headers'] = WSGIHeaderDict(self.environ)
         return self.environ['bottle.headers']
 
     @property
     def GET(self):
-        """ The QUERY_STRING parsed into a MultiDict.
+        """ The QUERY_STRING parsed into a :class:`QueryDict`.
 
             Keys and values are strings. Multiple values per key are possible.
-            See MultiDict for details.
+            See MultiDict for details. The max_params and max_param_key
+            limits (see :meth:`get_limit`) apply.
         """
         if 'bottle.get' not in self.environ:
-            data = parse_qs(self.query_string, keep_blank_values=True)
-            get = self.environ['bottle.get'] = MultiDict()
-            for key, values in data.iteritems():
-                for value in values:
-                    get[key] = value
+            self.environ['bottle.get'] = parse_query(self.query_string,
+                self.get_limit('max_params'), self.get_limit('max_param_key'))
         return self.environ['bottle.get']
 
     @property
@@ -704,31 +1298,45 @@ class Request(threading.local, DictMixin):
 
             This supports urlencoded and multipart POST requests. Multipart
             is commonly used for file uploads and may result in some of the
-            values beeing cgi.FieldStorage objects instead of strings.
+            values beeing :class:`MultipartPart` objects instead of strings.
+
+            Multipart bodies are parsed directly from `wsgi.input` if
+            :attr:`body` was not accessed before. In that case, the raw body
+            is not available afterwards.
 
             Multiple values per key are possible. See MultiDict for details.
         """
         if 'bottle.post' not in self.environ:
-            self.environ['bottle.post'] = MultiDict()
-            self.environ['bottle.forms'] = MultiDict()
-            self.environ['bottle.files'] = MultiDict()
-            safe_env = {'QUERY_STRING':''} # Build a safe environment for cgi
-            for key in ('REQUEST_METHOD', 'CONTENT_TYPE', 'CONTENT_LENGTH'):
-                if key in self.environ: safe_env[key] = self.environ[key]
-            if NCTextIOWrapper:
-                fb = NCTextIOWrapper(self.body, encoding='ISO-8859-1', newline='\n')
-                # TODO: Content-Length may be wrong now. Does cgi.FieldStorage
-                # use it at all? I think not, because all tests pass.
-            else:
-                fb = self.body
-            data = cgi.FieldStorage(fp=fb, environ=safe_env, keep_blank_values=True)
-            for item in data.list or []:
-                if item.filename:
-                    self.environ['bottle.post'][item.name] = item
-                    self.environ['bottle.files'][item.name] = item
-                else:
-                    self.environ['bottle.post'][item.name] = item.value
-                    self.environ['bottle.forms'][item.name] = item.value
+            post = self.environ['bottle.post'] = MultiDict()
+            forms = self.environ['bottle.forms'] = MultiDict()
+            files = self.environ['bottle.files'] = MultiDict()
+            if self.method in ('GET', 'HEAD'):
+                return post
+            ctype, options = cgi.parse_header(self.environ.get('CONTENT_TYPE', ''))
+            max_fields = self.get_limit('max_fields')
+            max_field_size = self.get_limit('max_field_size')
+            if ctype == 'multipart/form-data':
+                stream, maxread = self._take_input()
+                memfile_max = self.config.get('memfile_max', MEMFILE_MAX)
+                parser = MultipartParser(stream, options.get('boundary', ''),
+                             maxread, memfile_max,
+                             max_size=self.get_limit('max_body_size'),
+                             max_fields=max_fields, max_field_size=max_field_size,
+                             max_upload_size=self.get_limit('max_upload_size'))
+                for part in parser:
+                    if part.filename:
+                        post[part.name] = files[part.name] = part
+                    else:
+                        post[part.name] = forms[part.name] = part.value
+            elif ctype in ('', 'application/x-www-form-urlencoded'):
+                data = parse_qs(self.body.read(), keep_blank_values=True)
+                if max_fields is not None and sum(map(len, data.itervalues())) > max_fields:
+                    raise HTTPError(413, 'Too many form fields.')
+                for key, values in data.iteritems():
+                    for value in values:
+                        if max_field_size is not None and len(value) > max_field_size:
+                            raise HTTPError(413, 'Form field too large: %s' % key)
+                        post[key] = forms[key] = value
         return self.environ['bottle.post']
 
     @property
@@ -745,34 +1353,135 @@ class Request(threading.local, DictMixin):
         
     @property
     def params(self):
-        """ A combined MultiDict with POST and GET parameters. """
+        """ A read-only :class:`MultiDictView` of GET and POST form parameters.
+            Form values take precedence over GET values. """
         if 'bottle.params' not in self.environ:
-            self.environ['bottle.params'] = MultiDict(self.GET)
-            self.environ['bottle.params'].update(dict(self.forms))
+            self.environ['bottle.params'] = MultiDictView(self.GET, self.forms)
         return self.environ['bottle.params']
 
+    def get_limit(self, name):
+        """ Return a request size limit or None. Limits set for the current
+            route (see :func:`limit`) override the application config.
+
+            Known limits: max_body_size, max_fields, max_field_size and
+            max_upload_size (in bytes, except for max_fields). Exceeding a
+            limit causes a HTTPError(413). The query string limits max_params
+            and max_param_key (key length) cause a HTTPError(400).
+        """
+        value = self.environ.get('bottle.limits', {}).get(name)
+        return self.config.get(name) if value is None else value
+
+    def _input_length(self):
+        ''' Number of bytes to read from `wsgi.input`. If Content-Length is
+            missing, read until EOF only if the server says that this is
+            safe (wsgi.input_terminated, e.g. for de-chunked input). '''
+        if self.content_length >= 0:
+            return self.content_length
+        return -1 if self.environ.get('wsgi.input_terminated') else 0
+
+    def _take_input(self):
+        ''' Return a (stream, maxread) tuple to read the request body once.
+            If the body is not buffered yet, `wsgi.input` is returned and
+            replaced by an empty buffer. '''
+        if 'bottle.body' in self.environ:
+            return self.body, -1
+        stream, maxread = self.environ['wsgi.input'], self._input_length()
+        self.environ['wsgi.input'] = self.environ['bottle.body'] = BytesIO()
+        return stream, maxread
+
+    @property
+    def stream(self):
+        """ An iterator over the HTTP request body in blocks of bytes.
+
+            If :attr:`body` was not accessed before, the blocks are read
+            directly from `wsgi.input` (but not more than Content-Length
+            bytes) without buffering. The body can be read only once this
+            way. :attr:`body` is empty afterwards.
+        """
+        stream, maxread = self._take_input()
+        return read_blocks(stream, maxread, self.config.get('body_chunk', MEMFILE_MAX),
+                           self.get_limit('max_body_size'))
+
     @property
     def body(self):
         """ The HTTP request body as a seekable buffer object.
         
             This property returns a copy of the `wsgi.input` stream and should
-            be used instead of `environ['wsgi.input']`.
+            be used instead of `environ['wsgi.input']`. The copy is made on
+            first access. Use :attr:`stream` to read large bodies without
+            buffering them.
+
+            Bodies up to `memfile_max` bytes (app config, defaults to
+            MEMFILE_MAX) are kept in memory, larger ones are spooled to a
+            temporary file in chunks of `body_chunk` bytes. Spooling reads
+            into a reused buffer if the stream supports `readinto`.
          """
         if 'bottle.body' not in self.environ:
-            maxread = max(0, self.content_length)
+            maxread = self._input_length()
             stream = self.environ['wsgi.input']
-            body = BytesIO() if maxread < MEMFILE_MAX else TemporaryFile(mode='w+b')
-            while maxread > 0:
-                part = stream.read(min(maxread, MEMFILE_MAX))
-                if not part: #TODO: Wrong content_length. Error? Do nothing?
-                    break
-                body.write(part)
-                maxread -= len(part)
+            limit = self.get_limit('max_body_size')
+            if 0 <= maxread <= self.config.get('memfile_max', MEMFILE_MAX):
+                if limit is not None and maxread > limit:
+                    raise HTTPError(413, 'Request entity too large.')
+                body = BytesIO(read_buffer(stream, maxread))
+            else:
+                body = TemporaryFile(mode='w+b')
+                chunk = self.config.get('body_chunk', MEMFILE_MAX)
+                for part in readinto_blocks(stream, maxread, chunk, limit):
+                    body.write(part)
             self.environ['wsgi.input'] = body
             self.environ['bottle.body'] = body
         self.environ['bottle.body'].seek(0)
         return self.environ['bottle.body']
 
+    @property
+    def body_view(self):
+        """ A memoryview of the request body if it was buffered in memory
+            (see :attr:`body`), or None. The view shares the buffer of
+            :attr:`body`, no copy is made. """
+        body = self.body
+        if hasattr(body, 'getbuffer'): # io.BytesIO (py3)
+            return body.getbuffer()
+        if hasattr(body, 'getvalue'): # StringIO.StringIO (py2) holds a str
+            return memoryview(body.getvalue())
+        return None
+
+    @property
+    def json(self):
+        """ The request body decoded as JSON, or None if the Content-Type is
+            not application/json or the body is empty.
+
+            Bodies larger than the max_json_size limit (see :meth:`get_limit`)
+            are rejected with HTTPError(413), invalid JSON with HTTPError(400).
+            The decoder can be replaced with the `json_loads` config key.
+        """
+        if 'bottle.json' not in self.environ:
+            data = None
+            ctype = self.environ.get('CONTENT_TYPE', '').split(';')[0]
+            if ctype.strip().lower() == 'application/json':
+                limit = self.get_limit('max_json_size')
+                if limit is not None and self.content_length > limit:
+                    raise HTTPError(413, 'Request entity too large.')
+                raw = self._body_bytes()
+                if limit is not None and len(raw) > limit:
+                    raise HTTPError(413, 'Request entity too large.')
+                if raw:
+                    loads = self.config.get('json_loads') or json_loads
+                    try:
+                        data = loads(raw)
+                    except ValueError, e:
+                        raise HTTPError(400, 'Invalid JSON body.', e)
+            self.environ['bottle.json'] = data
+        return self.environ['bottle.json']
+
+    def _body_bytes(self):
+        """ The whole body as a byte string. In-memory bodies are returned
+            without a copy (py2), spooled files are read in one call. """
+        body = self.body
+        if hasattr(body, 'getvalue'):
+            return body.getvalue()
+        return body.read()
+
     @property
     def auth(self): #TODO: Tests and docs. Add support for digest. namedtuple?
         """ HTTP authorisation data as a (user, passwd) tuple. (experimental)
@@ -790,14 +1499,13 @@ class Request(threading.local, DictMixin):
             Request.get_cookie() for details.
         """
         if 'bottle.cookies' not in self.environ:
-            raw_dict = SimpleCookie(self.environ.get('HTTP_COOKIE',''))
-            self.environ['bottle.cookies'] = {}
-            for cookie in raw_dict.itervalues():
-                self.environ['bottle.cookies'][cookie.key] = cookie.value
+            cookies = CookieDict(self.environ.get('HTTP_COOKIE', ''))
+            self.environ['bottle.cookies'] = cookies
         return self.environ['bottle.cookies']
 
     def get_cookie(self, name, secret=None):
-        """ Return the (decoded) value of a cookie. """
+        """ Return the (decoded) value of a cookie. The secret may be a key, a
+            list of keys or a :class:`CookieSigner`. """
         value = self.COOKIES.get(name)
         dec = cookie_decode(value, secret) if secret else None
         return dec or value
@@ -821,7 +1529,7 @@ class Response(threading.local):
         """ Resets the Response object to its factory defaults. """
         self._COOKIES = None
         self.status = 200
-        self.headers = HeaderDict()
+        self.headers = ResponseHeaders()
         self.content_type = 'text/html; charset=UTF-8'
         self.config = config or {}
 
@@ -835,10 +1543,11 @@ class Response(threading.local):
 
     def wsgiheader(self):
         ''' Returns a wsgi conform list of header/value pairs. '''
-        for c in self.COOKIES.values():
-            if c.OutputString() not in self.headers.getall('Set-Cookie'):
-                self.headers.append('Set-Cookie', c.OutputString())
-        return list(self.headers.iterallitems())
+        headers = list(self.headers.iterallitems())
+        if self._COOKIES:
+            for c in self._COOKIES.values():
+                headers.append(('Set-Cookie', c.OutputString()))
+        return headers
     headerlist = property(wsgiheader)
 
     @property
@@ -861,7 +1570,8 @@ class Response(threading.local):
     def set_cookie(self, key, value, secret=None, **kargs):
         """ Add a new cookie with various options.
         
-        If the cookie value is not a string, a secure cookie is created.
+        If the cookie value is not a string, a secure cookie is created. The
+        secret may be a key, a list of keys or a :class:`CookieSigner`.
         
         Possible options are:
             expires, path, comment, domain, max_age, secure, version, httponly
@@ -890,6 +1600,137 @@ class Response(threading.local):
 
 
 
+class MultipartParser(object):
+    """ Incremental parser for multipart/form-data request bodies.
+
+        The stream is read in blocks of `buffer_size` bytes (but not more
+        than `content_length`, if that is not negative) and split at the
+        boundary with str.find(). Parts are kept in memory up to
+        `memfile_max` bytes and spooled to a temporary file beyond that.
+        Iterate over the parser to get :class:`MultipartPart` objects.
+
+        Like cgi.FieldStorage, the parser accepts bare LF line endings.
+        HTTPError(413) is raised if the body exceeds `max_size` bytes, if there
+        are more than `max_fields` parts or if a single field or file exceeds
+        `max_field_size` or `max_upload_size` bytes.
+    """
+    header_end = re.compile(tob(r'\r?\n\r?\n'))
+
+    def __init__(self, stream, boundary, content_length=-1,
+                 memfile_max=None, buffer_size=2**16, header_max=2**16,
+                 max_size=None, max_fields=None, max_field_size=None,
+                 max_upload_size=None):
+        if not boundary:
+            raise MultipartError("No boundary for multipart/form-data.")
+        self.stream = stream
+        self.boundary = tob(boundary)
+        self.content_length = content_length
+        self.memfile_max = memfile_max or MEMFILE_MAX
+        self.buffer_size = buffer_size
+        self.header_max = header_max
+        self.max_size = max_size
+        self.max_fields = max_fields
+        self.max_field_size = max_field_size
+        self.max_upload_size = max_upload_size
+
+    def __iter__(self):
+        nl, dash = tob('\n'), tob('--')
+        delim = dash + self.boundary
+        dlen = len(delim) + 2
+        blocks = read_blocks(self.stream, self.content_length, self.buffer_size,
+                             self.max_size)
+        buf, part, start, count = nl, None, 0, 0 # A delimiter must follow a newline.
+        while True:
+            pos = buf.find(delim, start)
+            if pos >= 0 and buf[pos-1:pos] != nl:
+                start = pos + 1 # Not at the start of a line. Keep searching.
+                continue
+            if pos < 0:
+                if part:
+                    part.write(buf[:-dlen])
+                buf = buf[-dlen:] + self._next(blocks)
+                start = 0
+                continue
+            if part:
+                end = pos - 2 if buf[pos-2:pos-1] == tob('\r') else pos - 1
+                part.write(buf[:end])
+                part.finish()
+                yield part
+            buf, start = buf[pos + len(delim):], 0
+            while len(buf) < 2:
+                buf += self._next(blocks)
+            if buf[:2] == dash:
+                return # Closing delimiter. Ignore the epilogue.
+            match = self.header_end.search(buf)
+            while not match:
+                if len(buf) > self.header_max:
+                    raise MultipartError("Multipart part header too long.")
+                buf += self._next(blocks)
+                match = self.header_end.search(buf)
+            header, buf = buf[:match.start()], buf[match.end():]
+            count += 1
+            if self.max_fields is not None and count > self.max_fields:
+                raise HTTPError(413, 'Too many form fields.')
+            part = MultipartPart(header, self.memfile_max)
+            part.max_size = self.max_field_size if not part.filename\
+                            else self.max_upload_size
+
+    def _next(self, blocks):
+        for block in blocks:
+            return block
+        raise MultipartError("Unexpected end of multipart/form-data body.")
+
+
+class MultipartPart(object):
+    """ A single part of a multipart/form-data body. Field values are
+        available as :attr:`value`, file uploads as :attr:`file`. """
+
+    def __init__(self, header, memfile_max):
+        self.headers = HeaderDict()
+        for line in header.splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                self.headers[key.strip()] = value.strip()
+        disposition, options = cgi.parse_header(self.headers.get('Content-Disposition', ''))
+        if 'name' not in options:
+            raise MultipartError("Invalid Content-Disposition in multipart part.")
+        self.name = options['name']
+        self.filename = options.get('filename')
+        self.type = self.headers.get('Content-Type', 'text/plain')
+        self.memfile_max = memfile_max
+        self.max_size = None
+        self.file = BytesIO()
+        self.size = 0
+
+    def write(self, data):
+        if not data: return
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise HTTPError(413, 'Form field or file too large: %s' % self.name)
+        if self.size > self.memfile_max and not hasattr(self.file, 'fileno'):
+            spool = TemporaryFile(mode='w+b')
+            spool.write(self.file.getvalue())
+            self.file = spool
+        self.file.write(data)
+
+    def finish(self):
+        self.file.seek(0)
+
+    @property
+    def value(self):
+        """ The content of this part as a string (read from :attr:`file`). """
+        self.file.seek(0)
+        value = self.file.read()
+        self.file.seek(0)
+        if sys.version_info >= (3,0,0): # pragma: no cover
+            value = value.decode('ISO-8859-1')
+        return value
+
+
+
+
+
+
 # Data Structures
 
 class MultiDict(DictMixin):
@@ -923,6 +1764,169 @@ class MultiDict(DictMixin):
                 yield key, value
 
 
+class EnvironOverlay(DictMixin):
+    """ A copy-on-write view of a WSGI environ. Changes and deletions are
+        recorded in the overlay, everything else is read from the parent, so
+        creating it costs O(changes) instead of O(environ). The parent should
+        not be changed while the overlay is in use. Use dict(overlay) where a
+        real dict is needed. """
+    def __init__(self, parent):
+        if isinstance(parent, EnvironOverlay):
+            self.parent = parent.parent
+            self.changes, self.deleted = parent.changes.copy(), parent.deleted.copy()
+        else:
+            self.parent, self.changes, self.deleted = parent, {}, set()
+
+    def __getitem__(self, key):
+        if key in self.changes: return self.changes[key]
+        if key in self.deleted: raise KeyError(key)
+        return self.parent[key]
+
+    def get(self, key, default=None):
+        if key in self.changes: return self.changes[key]
+        if key in self.deleted: return default
+        return self.parent.get(key, default)
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self: raise KeyError(key)
+        self.changes.pop(key, None)
+        self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.changes: return True
+        return key not in self.deleted and key in self.parent
+
+    def __iter__(self):
+        for key in self.changes:
+            yield key
+        for key in self.parent:
+            if key not in self.changes and key not in self.deleted:
+                yield key
+
+    def __len__(self): return len(self.keys())
+    def keys(self): return [key for key in self]
+    def copy(self): return EnvironOverlay(self)
+
+
+class MultiDictView(DictMixin):
+    """ A read-only view of several :class:`MultiDict` layers. Nothing is
+        copied. For single values, later layers shadow earlier ones. getall()
+        returns the values of all layers in order. """
+    def __init__(self, *layers):
+        self.layers = layers
+
+    def __contains__(self, key):
+        for layer in self.layers:
+            if key in layer: return True
+        return False
+
+    def __iter__(self):
+        seen = set()
+        for layer in self.layers:
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self): return len(self.keys())
+    def keys(self): return [key for key in self]
+    def __getitem__(self, key): return self.get(key, KeyError, -1)
+    def __setitem__(self, key, value): raise TypeError("%s is read-only." % self.__class__)
+    def __delitem__(self, key): raise TypeError("%s is read-only." % self.__class__)
+
+    def get(self, key, default=None, index=-1):
+        if index == -1:
+            for layer in reversed(self.layers):
+                if key in layer: return layer.get(key)
+            values = []
+        else:
+            values = self.getall(key)
+        if not values:
+            if default == KeyError: raise KeyError(key)
+            return [default][index]
+        return values[index]
+
+    def getall(self, key):
+        values = []
+        for layer in self.layers:
+            values.extend(layer.getall(key))
+        return values
+
+    def iterallitems(self):
+        return itertools.chain(*[layer.iterallitems() for layer in self.layers])
+
+
+class QueryDict(MultiDict):
+    """ A :class:`MultiDict` for url-encoded data. Values are percent-decoded
+        on first access. """
+    def __init__(self, *a, **k):
+        self.encoded = set() # Keys with values that are not decoded yet.
+        MultiDict.__init__(self, *a, **k)
+
+    def decode(self, key):
+        if key in self.encoded:
+            self.encoded.discard(key)
+            self.dict[key] = map(urlunquote, self.dict[key])
+
+    def __delitem__(self, key): self.encoded.discard(key); del self.dict[key]
+    def append(self, key, value): self.decode(key); MultiDict.append(self, key, value)
+    def replace(self, key, value): self.encoded.discard(key); MultiDict.replace(self, key, value)
+    def getall(self, key): self.decode(key); return MultiDict.getall(self, key)
+
+    def get(self, key, default=None, index=-1):
+        self.decode(key)
+        return MultiDict.get(self, key, default, index)
+
+    def iterallitems(self):
+        for key in list(self.encoded):
+            self.decode(key)
+        return MultiDict.iterallitems(self)
+
+
+class CookieDict(DictMixin):
+    """ A dict of request cookies, parsed from a Cookie header with a single
+        split. Quoted values are unquoted on first access. Like SimpleCookie,
+        this skips $-attributes, cookie attributes (path, expires, ...) and
+        pairs without a '=', and later cookies overwrite earlier ones. """
+    attributes = ('expires', 'path', 'comment', 'domain', 'max-age', 'secure',
+                  'httponly', 'version')
+    #: Splits a header with quoted values at semicolons outside of quotes
+    splitter = re.compile(r'(?:"(?:[^\\"]|\\.)*"|[^;])+').findall
+
+    def __init__(self, header=''):
+        self.dict = {}
+        self.encoded = set() # Keys with quoted values
+        pairs = self.splitter(header) if '"' in header else header.split(';')
+        for pair in pairs:
+            key, sep, value = pair.partition('=')
+            key = key.strip()
+            if not sep or not key or key[0] == '$' or key.lower() in self.attributes:
+                continue
+            value = value.strip()
+            self.dict[key] = value
+            if value[:1] == '"':
+                self.encoded.add(key)
+            else:
+                self.encoded.discard(key)
+
+    def __getitem__(self, key):
+        if key in self.encoded:
+            self.encoded.discard(key)
+            self.dict[key] = cookie_unquote(self.dict[key])
+        return self.dict[key]
+
+    def __setitem__(self, key, value): self.encoded.discard(key); self.dict[key] = value
+    def __delitem__(self, key): self.encoded.discard(key); del self.dict[key]
+    def __contains__(self, key): return key in self.dict
+    def __iter__(self): return iter(self.dict)
+    def __len__(self): return len(self.dict)
+    def keys(self): return self.dict.keys()
+
+
 class HeaderDict(MultiDict):
     """ Same as :class:`MultiDict`, but title()s the keys and overwrites by default. """
     def __contains__(self, key): return MultiDict.__contains__(self, self.httpkey(key))
@@ -936,6 +1940,349 @@ class HeaderDict(MultiDict):
     def httpkey(self, key): return str(key).replace('_','-').title()
 
 
+class WSGIHeaderDict(DictMixin):
+    """ A read-only, case-insensitive view of the HTTP request headers in a
+        WSGI environ. Header names are translated to environ keys (e.g.
+        'X-Requested-With' to 'HTTP_X_REQUESTED_WITH') and looked up directly,
+        so nothing is copied. Only iteration walks the whole environ. """
+    #: Headers without the HTTP_ prefix in the environ (see PEP 333)
+    cgikeys = ('CONTENT_TYPE', 'CONTENT_LENGTH')
+    #: Cache for header name -> environ key translations
+    ekeys = {}
+
+    def __init__(self, environ):
+        self.environ = environ
+
+    def _ekey(self, key):
+        try:
+            return self.ekeys[key]
+        except KeyError:
+            ekey = str(key).replace('-','_').upper()
+            if ekey not in self.cgikeys:
+                ekey = 'HTTP_' + ekey
+            if len(self.ekeys) < 1000:
+                self.ekeys[key] = ekey
+            return ekey
+
+    def __getitem__(self, key): return self.environ[self._ekey(key)]
+    def __contains__(self, key): return self._ekey(key) in self.environ
+    def __setitem__(self, key, value): raise TypeError("%s is read-only." % self.__class__)
+    def __delitem__(self, key): raise TypeError("%s is read-only." % self.__class__)
+    def __len__(self): return len(self.keys())
+    def keys(self): return [key for key in self]
+    def get(self, key, default=None, index=-1): return self.environ.get(self._ekey(key), default)
+    def getall(self, key): return [self[key]] if key in self else []
+
+    def __iter__(self):
+        for key in self.environ:
+            if key[:5] == 'HTTP_':
+                yield key[5:].replace('_', '-').title()
+            elif key in self.cgikeys:
+                yield key.replace('_', '-').title()
+
+    def iterallitems(self):
+        for key in self:
+            yield key, self[key]
+
+
+class ResponseHeaders(DictMixin):
+    """ A :class:`HeaderDict` replacement for response headers. Header names
+        are normalized through a shared cache of interned names and single
+        values are stored without a list. Overwrites by default. """
+    #: Cache for header name -> normalized header name translations
+    hkeys = dict((key, key) for key in ('Content-Type', 'Content-Length',
+        'Content-Encoding', 'Content-Disposition', 'Location', 'Set-Cookie',
+        'Cache-Control', 'Expires', 'Last-Modified', 'ETag', 'Vary', 'Allow',
+        'Date', 'Server', 'Accept-Ranges'))
+
+    def __init__(self, *a, **ka):
+        self.dict = {}
+        for key, value in dict(*a, **ka).iteritems():
+            self[key] = value
+
+    def httpkey(self, key):
+        try:
+            return self.hkeys[key]
+        except (KeyError, TypeError):
+            hkey = intern(str(key).replace('_','-').title())
+            if len(self.hkeys) < 1000 and isinstance(key, str):
+                self.hkeys[key] = hkey
+            return hkey
+
+    def __len__(self): return len(self.dict)
+    def __iter__(self): return iter(self.dict)
+    def __contains__(self, key): return self.httpkey(key) in self.dict
+    def __delitem__(self, key): del self.dict[self.httpkey(key)]
+    def __getitem__(self, key): return self.get(key, KeyError)
+    def __setitem__(self, key, value): self.replace(key, value)
+    def keys(self): return self.dict.keys()
+
+    def copy(self):
+        copy = self.__class__()
+        for key, value in self.dict.iteritems():
+            copy.dict[key] = list(value) if type(value) is list else value
+        return copy
+
+    def replace(self, key, value):
+        self.dict[self.httpkey(key)] = value if type(value) is str else str(value)
+
+    def append(self, key, value):
+        key = self.httpkey(key)
+        value = value if type(value) is str else str(value)
+        if key not in self.dict:
+            self.dict[key] = value
+        elif type(self.dict[key]) is list:
+            self.dict[key].append(value)
+        else:
+            self.dict[key] = [self.dict[key], value]
+
+    def getall(self, key):
+        value = self.dict.get(self.httpkey(key))
+        if value is None: return []
+        return list(value) if type(value) is list else [value]
+
+    def get(self, key, default=None, index=-1):
+        key = self.httpkey(key)
+        if key not in self.dict:
+            if default is KeyError: raise KeyError(key)
+            return [default][index]
+        value = self.dict[key]
+        return value[index] if type(value) is list else [value][index]
+
+    def iterallitems(self):
+        for key, value in self.dict.iteritems():
+            if type(value) is list:
+                for item in value:
+                    yield key, item
+            else:
+                yield key, value
+
+
+class MethodMap(dict):
+    """ A method->target dict for a single route. HEAD falls back to GET and
+        all other methods fall back to ANY, so that a single lookup is enough.
+        Unknown methods map to None. """
+
+    def __init__(self, *a, **ka):
+        dict.__init__(self, *a, **ka)
+        self.any = self.get('ANY')
+        if 'GET' in self and 'HEAD' not in self:
+            self['HEAD'] = self['GET']
+
+    def __missing__(self, method):
+        return self.any
+
+
+class LazyHandler(object):
+    """ A callable that imports its target from a 'module:function' string on
+        first use. Useful for handlers in rarely used modules. Unknown
+        attributes (e.g. route options set by decorators) are read from the
+        target. """
+
+    def __init__(self, target):
+        self.target = target
+        self.__name__ = target
+        self.func = None
+
+    def load(self):
+        if self.func is None:
+            self.func = load(self.target)
+        return self.func
+
+    def __call__(self, *a, **ka):
+        return self.load()(*a, **ka)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('target', 'func'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.target)
+
+
+class LRUCache(object):
+    """ A bounded, thread-safe mapping that discards the least recently used
+        items first. Counts cache hits and misses. If `maxbytes` is set, the
+        total `sizeof(value)` of all items is bounded, too. """
+
+    def __init__(self, maxsize=1000, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.data = {} # key -> [prev, next, key, value, size]
+            self.root = [None, None, None, None, 0]
+            self.root[0] = self.root[1] = self.root
+            self.bytes = 0
+
+    def __len__(self): return len(self.data)
+    def __contains__(self, key): return key in self.data
+    def __iter__(self): return iter(self.data.keys())
+    def keys(self): return self.data.keys()
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError: raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.data.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        with self.lock:
+            link = self.data.get(key)
+            if link is not None:
+                self._unlink(link)
+                self.bytes -= link[4]
+                link[3], link[4] = value, size
+            else:
+                link = self.data[key] = [None, None, key, value, size]
+            self.bytes += size
+            self._append(link)
+            while len(self.data) > self.maxsize or self.maxbytes is not None\
+            and self.bytes > self.maxbytes:
+                oldest = self.root[1]
+                self._unlink(oldest)
+                del self.data[oldest[2]]
+                self.bytes -= oldest[4]
+
+    def __delitem__(self, key):
+        with self.lock:
+            link = self.data.pop(key)
+            self._unlink(link)
+            self.bytes -= link[4]
+
+    def _unlink(self, link):
+        link[0][1], link[1][0] = link[1], link[0]
+
+    def _append(self, link):
+        last = self.root[0]
+        link[0], link[1] = last, self.root
+        last[1] = self.root[0] = link
+
+
+class MemoryCacheStore(object):
+    """ An in-process store for :func:`cache`. Entries are evicted least
+        recently used first if there are more than `maxsize` entries or they
+        take more than `maxbytes` bytes. """
+
+    def __init__(self, maxsize=1000, maxbytes=2**26):
+        self.cache = LRUCache(maxsize, maxbytes, lambda entry: len(entry[4]))
+
+    def get(self, key): return self.cache.get(key)
+    def set(self, key, entry): self.cache[key] = entry
+    def keys(self): return self.cache.keys()
+
+    def delete(self, key):
+        try: del self.cache[key]
+        except KeyError: pass
+
+    def purge(self, prefix=''):
+        for key in self.keys():
+            if key.startswith(prefix): self.delete(key)
+
+
+class FileCacheStore(object):
+    """ A store for :func:`cache` that keeps one file per entry in a
+        directory, so all worker processes on a host share the cache. Reads
+        refresh the file modification time. If there are more than `maxsize`
+        entries or they take more than `maxbytes` bytes, the least recently
+        used files are removed.
+
+        The directory is only scanned if the number or size of the entries
+        (estimated from the last scan and the writes since) exceeds a limit,
+        and every `prune_every` writes to catch writes of other processes.
+        """
+
+    def __init__(self, path, maxsize=1000, maxbytes=2**26, prune_every=100):
+        self.path = os.path.abspath(path)
+        self.maxsize, self.maxbytes = maxsize, maxbytes
+        self.prune_every = prune_every
+        self.count = self.size = None # Estimated entries and bytes
+        self.writes = 0 # Writes since the last scan
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(tob(key)).hexdigest() + '.cache')
+
+    def _files(self):
+        names = [name for name in os.listdir(self.path) if name.endswith('.cache')]
+        return [os.path.join(self.path, name) for name in names]
+
+    def _load(self, filename):
+        try:
+            with open(filename, 'rb') as fp:
+                return marshal.load(fp)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def get(self, key):
+        filename = self._filename(key)
+        entry = self._load(filename)
+        if entry is None or entry[0] != key:
+            return None
+        try: os.utime(filename, None)
+        except OSError: pass
+        return entry
+
+    def set(self, key, entry):
+        fd, tmpname = mkstemp('.tmp', '', self.path)
+        with os.fdopen(fd, 'wb') as fp:
+            marshal.dump(entry, fp, 2)
+            written = fp.tell()
+        os.rename(tmpname, self._filename(key))
+        self.writes += 1
+        if self.count is None or self.writes >= self.prune_every:
+            return self._prune()
+        self.count += 1
+        self.size += written
+        if self.count > self.maxsize or self.size > self.maxbytes:
+            self._prune()
+
+    def delete(self, key):
+        try: os.remove(self._filename(key))
+        except OSError: pass
+
+    def keys(self):
+        entries = [self._load(filename) for filename in self._files()]
+        return [entry[0] for entry in entries if entry]
+
+    def purge(self, prefix=''):
+        for key in self.keys():
+            if key.startswith(prefix): self.delete(key)
+
+    def _prune(self):
+        files = []
+        for filename in self._files():
+            try: stat = os.stat(filename)
+            except OSError: continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+        files.sort()
+        size = sum(item[1] for item in files)
+        while files and (len(files) > self.maxsize or size > self.maxbytes):
+            mtime, fsize, filename = files.pop(0)
+            size -= fsize
+            try: os.remove(filename)
+            except OSError: pass
+        self.count, self.size, self.writes = len(files), size, 0
+
+
 class AppStack(list):
     """ A stack implementation. """
 
@@ -1054,21 +2401,230 @@ def parse_auth(header):
         return None
 
 
+def read_blocks(stream, maxread=-1, bufsize=2**16, limit=None):
+    """ Read a file-like object in blocks of up to `bufsize` bytes. Stop after
+        `maxread` bytes unless it is negative, or at the end of the stream.
+        Raise HTTPError(413) as soon as more than `limit` bytes were read. """
+    while maxread != 0:
+        block = stream.read(bufsize if maxread < 0 else min(maxread, bufsize))
+        if not block:
+            break
+        if maxread > 0:
+            maxread -= len(block)
+        if limit is not None:
+            limit -= len(block)
+            if limit < 0:
+                raise HTTPError(413, 'Request entity too large.')
+        yield block
+
+
+def readinto_blocks(stream, maxread=-1, bufsize=2**16, limit=None):
+    """ Like :func:`read_blocks`, but read into a single reused buffer if the
+        stream supports `readinto`. Each yielded block is only valid until the
+        next one is requested. """
+    readinto = getattr(stream, 'readinto', None)
+    if readinto is None:
+        for block in read_blocks(stream, maxread, bufsize, limit):
+            yield block
+        return
+    view = memoryview(bytearray(bufsize))
+    while maxread != 0:
+        size = readinto(view if maxread < 0 or maxread >= bufsize else view[:maxread])
+        if not size:
+            break
+        if maxread > 0:
+            maxread -= size
+        if limit is not None:
+            limit -= size
+            if limit < 0:
+                raise HTTPError(413, 'Request entity too large.')
+        yield view[:size]
+
+
+def read_buffer(stream, size):
+    """ Read up to `size` bytes and return them as a single byte string. A
+        complete first read is returned as is, so that it can be passed to
+        :class:`BytesIO` without another copy. (A preallocated bytearray
+        would not help here: Both StringIO.StringIO and io.BytesIO copy it.)
+        Short reads are joined. """
+    data = stream.read(size)
+    if not data or len(data) == size:
+        return data
+    parts = [data]
+    size -= len(data)
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return tob('').join(parts)
+
+
+def parse_query(qs, max_params=None, max_key=None):
+    """ Parse a url-encoded query string into a :class:`QueryDict` in a
+        single pass. Keys are decoded immediately, values on first access.
+        Blank values are kept. Raise HTTPError(400) if there are more than
+        `max_params` parameters or a key is longer than `max_key`. """
+    data = QueryDict()
+    if not qs:
+        return data
+    if ';' in qs:
+        qs = qs.replace(';', '&')
+    if '&' in qs:
+        pairs = [pair for pair in qs.split('&') if pair]
+        if max_params is not None and len(pairs) > max_params:
+            raise HTTPError(400, 'Too many query parameters.')
+    else:
+        pairs = (qs,)
+    values, encoded = data.dict, data.encoded
+    for pair in pairs:
+        key, sep, value = pair.partition('=')
+        if max_key is not None and len(key) > max_key:
+            raise HTTPError(400, 'Query parameter name too long.')
+        if '%' in key or '+' in key:
+            key = urlunquote(key)
+        if '%' in value or '+' in value:
+            encoded.add(key)
+        values.setdefault(key, []).append(value)
+    return data
+
+
+def _lscmp(a, b):
+    ''' Compare two strings in constant time (for equal lengths). '''
+    return not sum(0 if x == y else 1 for x, y in zip(a, b)) and len(a) == len(b)
+
+compare_digest = getattr(hmac, 'compare_digest', _lscmp)
+
+
+class CookieSigner(object):
+    """ Signs and verifies cookie values. Values are serialized with marshal
+        (no pickle) and signed with HMAC-SHA256. Only cookies with a valid
+        signature are unmarshalled. marshal is not safe against maliciously
+        constructed data, so anyone who knows a key can still crash the
+        interpreter with a crafted cookie. Keep the keys secret.
+
+        :param keys: A secret key or a list of keys. The first key signs new
+            cookies, all keys are accepted on verification. Add a new key to
+            the front of the list to rotate keys.
+        :param cache: Remember this many verified cookies to skip the HMAC
+            on repeated requests (0 disables the cache).
+    """
+
+    def __init__(self, keys, cache=0):
+        if not isinstance(keys, (list, tuple)):
+            keys = [keys]
+        self.keys = [tob(key) for key in keys]
+        self.cache = LRUCache(cache) if cache else None
+
+    def sign(self, msg, key):
+        return base64.b64encode(hmac.new(key, msg, hashlib.sha256).digest())
+
+    def encode(self, data):
+        ''' Serialize and sign an object. Return a byte string. '''
+        msg = base64.b64encode(marshal.dumps(data, 2))
+        return tob('!') + self.sign(msg, self.keys[0]) + tob('?') + msg
+
+    def decode(self, data):
+        ''' Verify and decode an encoded string. Return an object or None. '''
+        if isinstance(data, unicode): data = data.encode('ascii') #2to3 hack
+        if not cookie_is_encoded(data):
+            return None
+        msg = self.cache.get(data) if self.cache is not None else None
+        if msg is None:
+            sig, msg = data[1:].split(tob('?'), 1)
+            for key in self.keys:
+                if compare_digest(sig, self.sign(msg, key)):
+                    break
+            else:
+                return None
+            if self.cache is not None:
+                self.cache[data] = msg
+        try:
+            return marshal.loads(base64.b64decode(msg))
+        except (TypeError, ValueError, EOFError):
+            return None
+
+
+def cookie_signer(key):
+    ''' Return `key` if it is a :class:`CookieSigner`, or a new signer for a
+        key or a list of keys. '''
+    return key if isinstance(key, CookieSigner) else CookieSigner(key)
+
+
+def accept_encoding(header):
+    """ Return 'gzip' or 'deflate' (preferred in this order) if accepted by
+        an Accept-Encoding header, or None. """
+    accepted = {}
+    for token in header.split(','):
+        name, sep, params = token.partition(';')
+        qvalue = 1.0
+        for param in params.split(';'):
+            key, sep, value = param.partition('=')
+            if key.strip() == 'q':
+                try: qvalue = float(value)
+                except ValueError: qvalue = 0.0
+        accepted[name.strip().lower()] = qvalue
+    for encoding in ('gzip', 'deflate'):
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def cache_key(request, vary=()):
+    """ The response cache key for a request: The path (with SCRIPT_NAME) and
+        query string, followed by one line per header named in `vary`. GET
+        and HEAD requests share keys. Purge all entries for a path prefix
+        with `app.cache_store.purge(prefix)`. """
+    key = request.fullpath
+    if request.query_string:
+        key += '?' + request.query_string
+    for name in vary:
+        key += '\n%s: %s' % (name, request.header.get(name, ''))
+    return key
+
+
+def format_etag(tag):
+    """ Return `tag` as a quoted entity tag. Unquoted tags are made weak. """
+    tag = str(tag)
+    return tag if tag.startswith(('"', 'W/"')) else 'W/"%s"' % tag
+
+
+def etag_match(header, tag):
+    """ True if an If-None-Match header matches `tag` (weak comparison). """
+    if header.strip() == '*':
+        return True
+    tag = tag[2:] if tag.startswith('W/') else tag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+    return False
+
+
+def compress_iter(out, compressor):
+    """ Compress an iterable of byte strings chunk by chunk. """
+    try:
+        for chunk in out:
+            chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+    finally:
+        if hasattr(out, 'close'):
+            out.close()
+
+
 def cookie_encode(data, key):
-    ''' Encode and sign a pickle-able object. Return a string '''
-    msg = base64.b64encode(pickle.dumps(data, -1))
-    sig = base64.b64encode(hmac.new(key, msg).digest())
-    return u'!'.encode('ascii') + sig + u'?'.encode('ascii') + msg #2to3 hack
+    ''' Encode and sign an object (see :class:`CookieSigner`). Return a string '''
+    return cookie_signer(key).encode(data)
 
 
 def cookie_decode(data, key):
     ''' Verify and decode an encoded string. Return an object or None'''
-    if isinstance(data, unicode): data = data.encode('ascii') #2to3 hack
-    if cookie_is_encoded(data):
-        sig, msg = data.split(u'?'.encode('ascii'),1) #2to3 hack
-        if sig[1:] == base64.b64encode(hmac.new(key, msg).digest()):
-            return pickle.loads(base64.b64decode(msg))
-    return None
+    return cookie_signer(key).decode(data)
 
 
 def cookie_is_encoded(data):
@@ -1083,6 +2639,18 @@ def tonativefunc(enc='utf-8'):
     return lambda x: x.encode(enc) if isinstance(x, unicode) else str(x)
 
 
+def load(target):
+    """ Import a module and return an object from it. The target is a
+        'package.module:name' string. The name may contain dots to access
+        attributes (e.g. 'package.module:Class.method'). """
+    module, name = target.split(':', 1)
+    __import__(module)
+    obj = sys.modules[module]
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
 def yieldroutes(func):
     """ Return a generator for routes that match the signature (name, args) 
     of the func parameter. This may yield more than one route if the function
@@ -1156,6 +2724,63 @@ def validate(**vkargs):
     return decorator
 
 
+def _route_option(name, value):
+    """ Return a decorator that stores a route option in the
+    `_bottle_options` dict of the handler (see :meth:`Bottle.handle`). """
+    def decorator(func):
+        options = dict(getattr(func, '_bottle_options', None) or {})
+        options[name] = value
+        func._bottle_options = options
+        return func
+    return decorator
+
+
+def limit(**limits):
+    """
+    Overrides the request size limits of the application config for a single
+    route (see Request.get_limit). Requests with a Content-Length above
+    max_body_size are rejected with HTTPError(413) before the body is read.
+
+    This and the other route option decorators (:func:`compress`,
+    :func:`cache` and :func:`etag`) store their options on the handler
+    function. They may be placed above or below the route decorator, but no
+    decorator that wraps the handler (e.g. :func:`view` or :func:`validate`)
+    may sit in between.
+    """
+    return _route_option('limits', limits)
+
+
+def compress(enable=True, **options):
+    """
+    Enables (or disables) response compression for a single route, regardless
+    of the 'compress' setting of the application config. The level and
+    min_size options override 'compress_level' and 'compress_min_size'.
+    """
+    return _route_option('compress', dict(options, enable=enable))
+
+
+def cache(ttl=60, vary=()):
+    """
+    Caches the final response of a GET route for `ttl` seconds in the
+    cache_store of the application (see :func:`cache_key`). The handler and
+    output casting are skipped for cached responses. Requests that differ
+    in one of the headers named in `vary` are cached separately. Responses
+    with a status other than 200, cookies or a 'no-store' or 'private'
+    Cache-Control header are not cached.
+    """
+    return _route_option('cache', {'ttl': ttl, 'vary': tuple(vary)})
+
+
+def etag(func):
+    """
+    Sets a precomputed ETag for a single route. `func` is called with the
+    route arguments before the handler and returns a tag or None. If the
+    client already has the tag (If-None-Match), the handler is skipped and
+    304 Not Modified is returned.
+    """
+    return _route_option('etag', func)
+
+
 route  = functools.wraps(Bottle.route)(lambda *a, **ka: app().route(*a, **ka))
 get    = functools.wraps(Bottle.get)(lambda *a, **ka: app().get(*a, **ka))
 post   = functools.wraps(Bottle.post)(lambda *a, **ka: app().post(*a, **ka))
@@ -1721,6 +3346,8 @@ TEMPLATE_PATH = ['./', './views/']
 TEMPLATES = {}
 DEBUG = False
 MEMFILE_MAX = 1024*100
+COMPRESS_TYPES = ('text/', 'application/json', 'application/javascript',
+                  'application/xml', 'application/xhtml+xml', 'image/svg+xml')
 HTTP_CODES = {
     100: 'CONTINUE',
     101: 'SWITCHING PROTOCOLS',
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+""" Micro-benchmarks for request and response processing.
+
+    Run with: python benchmark.py [repeat]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bottle
+from Cookie import SimpleCookie
+
+COOKIE = '; '.join('tracker%d="value %d"' % (i, i) for i in range(30)) + '; session=abc'
+
+
+def simplecookie_lookup():
+    cookies = dict((c.key, c.value) for c in SimpleCookie(COOKIE).itervalues())
+    return cookies['session']
+
+
+def cookiedict_lookup():
+    return bottle.CookieDict(COOKIE)['session']
+
+
+SIGNER = bottle.CookieSigner('secret', cache=100)
+SIGNED = SIGNER.encode({'user': 'name', 'roles': ['admin', 'staff']})
+
+
+def signed_decode():
+    return bottle.cookie_decode(SIGNED, 'secret')
+
+
+def signed_decode_cached():
+    return SIGNER.decode(SIGNED)
+
+
+RESPONSE_COOKIES = SimpleCookie()
+for i in range(5):
+    RESPONSE_COOKIES['c%d' % i] = 'value'
+    RESPONSE_COOKIES['c%d' % i]['path'] = '/'
+
+
+def headers_headerdict():
+    headers = bottle.HeaderDict()
+    headers['Content-Type'] = 'text/html; charset=UTF-8'
+    headers['Content-Length'] = 1234
+    headers['Cache-Control'] = 'no-cache'
+    for c in RESPONSE_COOKIES.values():
+        if c.OutputString() not in headers.getall('Set-Cookie'):
+            headers.append('Set-Cookie', c.OutputString())
+    return list(headers.iterallitems())
+
+
+def headers_response():
+    response = bottle.Response()
+    response.headers['Content-Length'] = 1234
+    response.headers['Cache-Control'] = 'no-cache'
+    response._COOKIES = RESPONSE_COOKIES
+    return response.headerlist
+
+
+BENCHMARKS = [
+    ('Cookie: SimpleCookie, one lookup', simplecookie_lookup),
+    ('Cookie: CookieDict, one lookup', cookiedict_lookup),
+    ('Signed cookie: decode', signed_decode),
+    ('Signed cookie: decode, cached', signed_decode_cached),
+    ('Headers: HeaderDict, 5 cookies', headers_headerdict),
+    ('Headers: Response, 5 cookies', headers_response),
+]
+
+
+def run(repeat=10000):
+    for name, func in BENCHMARKS:
+        best = min(timeit.repeat(func, number=repeat, repeat=3))
+        print '%-40s %8.2f us' % (name, best / repeat * 1000000)
+
+
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:2]))
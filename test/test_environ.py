@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import unittest
 import sys, os.path
+import bottle
 from bottle import request, response
+from StringIO import StringIO
+from io import BytesIO
 import tools
 from tools import tob
 import wsgiref.util
@@ -68,6 +71,31 @@ class TestEnviron(unittest.TestCase):
         del request['PATH_INFO']
         self.assertTrue('PATH_INFO' not in request)
 
+    def test_copy(self):
+        """ Environ: Request.copy() records changes in an overlay """
+        e = {'PATH_INFO': '/a', 'QUERY_STRING': 'x=1', 'HTTP_COOKIE': 'c=1'}
+        r = bottle.Request(e)
+        self.assertEqual('1', r.GET['x'])
+        c = r.copy()
+        self.assertTrue(isinstance(c.environ, bottle.EnvironOverlay))
+        self.assertTrue(c.GET is r.GET)
+        c['QUERY_STRING'] = 'x=2'
+        c['PATH_INFO'] = '/b'
+        del c['HTTP_COOKIE']
+        self.assertEqual('2', c.GET['x'])
+        self.assertEqual('/b', c.path)
+        self.assertEqual({}, dict(c.COOKIES))
+        self.assertFalse('HTTP_COOKIE' in c)
+        self.assertEqual('1', r.GET['x'])
+        self.assertEqual('/a', r.path)
+        self.assertEqual('1', r.COOKIES['c'])
+        self.assertEqual(set(['PATH_INFO', 'QUERY_STRING', 'bottle.get', 'bottle.cookies']),
+                         set(c.keys()))
+        c2 = c.copy()
+        c2['QUERY_STRING'] = 'x=3'
+        self.assertEqual('3', c2.GET['x'])
+        self.assertEqual('2', c.GET['x'])
+
     def test_header_access(self):
         """ Environ: Request objects decode headers """
         e = {}
@@ -79,6 +107,24 @@ class TestEnviron(unittest.TestCase):
         self.assertTrue(request.header['Some-Header'] == 'some value')
         self.assertTrue(request.header['Some-Other-Header'] == 'some other value')
 
+    def test_header_view(self):
+        """ Environ: Request.header is a lazy view of the environ """
+        e = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest', 'HTTP_ACCEPT': '*/*',
+             'CONTENT_TYPE': 'text/plain', 'CONTENT_LENGTH': '5', 'PATH_INFO': '/'}
+        request.bind(e, None)
+        self.assertTrue(request.is_ajax)
+        self.assertEqual('text/plain', request.header['content-type'])
+        self.assertEqual('5', request.header.get('Content-Length'))
+        self.assertEqual(None, request.header.get('X-Missing'))
+        self.assertEqual(['*/*'], request.header.getall('Accept'))
+        self.assertEqual([], request.header.getall('X-Missing'))
+        self.assertEqual(set(['X-Requested-With', 'Accept', 'Content-Type',
+                              'Content-Length']), set(request.header.keys()))
+        self.assertEqual(4, len(request.header))
+        self.assertRaises(TypeError, request.header.__setitem__, 'Accept', 'x')
+        request['HTTP_ACCEPT'] = 'text/html'
+        self.assertEqual('text/html', request.header['Accept'])
+
     def test_cookie(self):
         """ Environ: COOKIES """ 
         t = dict()
@@ -89,6 +135,16 @@ class TestEnviron(unittest.TestCase):
             request.bind({'HTTP_COOKIE': k}, None)
             self.assertEqual(v, request.COOKIES)
 
+    def test_cookie_compat(self):
+        """ Environ: COOKIES are parsed like SimpleCookie does """
+        from Cookie import SimpleCookie
+        for header in ('', 'a=1; path=/; b=2', 'a="x\\"y"; b', ' a = 1 ;b=',
+                       '$Version=1; a=1; $Path=/', 'a="1"; a=2', 'a=%20; b="c d"',
+                       'a="x;y"; b=2', 'a="x\\";y"; b="z"'):
+            expected = dict((c.key, c.value) for c in SimpleCookie(header).values())
+            request.bind({'HTTP_COOKIE': header}, None)
+            self.assertEqual(expected, dict(request.COOKIES.items()))
+
     def test_get(self):
         """ Environ: GET data """ 
         e = {}
@@ -101,6 +157,27 @@ class TestEnviron(unittest.TestCase):
         self.assertEqual('1', request.GET['a'])
         self.assertEqual('b', request.GET['b'])
         
+    def test_get_decoding(self):
+        """ Environ: GET values are decoded like parse_qs does """
+        from urlparse import parse_qs
+        for qs in ('', 'a', 'a=', 'a=b+c', 'k%20ey=%41&k+ey=x;b=1&&c=%zz', '=x'):
+            request.bind({'QUERY_STRING': qs}, None)
+            expected = parse_qs(qs, keep_blank_values=True)
+            self.assertEqual(expected, dict((k, request.GET.getall(k))
+                                            for k in request.GET))
+        request.bind({'QUERY_STRING': 'a=%41&a=%42&b=%43'}, None)
+        self.assertEqual([('a', 'A'), ('a', 'B'), ('b', 'C')],
+                         sorted(request.GET.iterallitems()))
+
+    def test_get_limits(self):
+        """ Environ: GET rejects too many or too long parameters """
+        request.bind({'QUERY_STRING': 'a=1&b=2&c=3'}, {'max_params': 2})
+        self.assertRaises(bottle.HTTPError, lambda: request.GET)
+        request.bind({'QUERY_STRING': 'abc=1'}, {'max_param_key': 2})
+        self.assertRaises(bottle.HTTPError, lambda: request.GET)
+        request.bind({'QUERY_STRING': 'ab=1&b=2'}, {'max_params': 2, 'max_param_key': 2})
+        self.assertEqual('1', request.GET['ab'])
+
     def test_post(self):
         """ Environ: POST data """ 
         sq = u'a=a&a=1&b=b&c=&d'.encode('utf8')
@@ -145,6 +222,20 @@ class TestEnviron(unittest.TestCase):
         request.POST # This caused a body.close() with Python 3.x
         self.assertEqual(sq, request.body.read())
 
+    def test_post_other_types(self):
+        """ Environ: Only urlencoded and multipart bodies fill POST """
+        e = {}
+        wsgiref.util.setup_testing_defaults(e)
+        e['wsgi.input'].write(tob('{"a":"b=c"}'))
+        e['wsgi.input'].seek(0)
+        e['CONTENT_LENGTH'] = '11'
+        e['CONTENT_TYPE'] = 'application/json'
+        e['REQUEST_METHOD'] = "POST"
+        request.bind(e, None)
+        self.assertEqual({}, dict(request.POST))
+        self.assertEqual({}, dict(request.forms))
+        self.assertEqual(tob('{"a":"b=c"}'), request.body.read())
+
     def test_params(self):
         """ Environ: GET and POST are combined in request.param """ 
         e = {}
@@ -157,6 +248,7 @@ class TestEnviron(unittest.TestCase):
         request.bind(e, None)
         self.assertEqual(['a','b','c'], sorted(request.params.keys()))
         self.assertEqual('p', request.params['c'])
+        self.assertEqual(['g', 'p'], request.params.getall('c'))
 
     def test_getpostleak(self):
         """ Environ: GET and POST sh0uld not leak into each other """ 
@@ -184,6 +276,86 @@ class TestEnviron(unittest.TestCase):
         self.assertEqual(u'abc'.encode('utf8'), request.body.readline())
         self.assertEqual(u'abc'.encode('utf8'), request.body.readline(3))
 
+    def test_body_chunks(self):
+        """ Environ: Request.body honors memfile_max and body_chunk """
+        for stream in (StringIO, BytesIO):
+            e = {}
+            wsgiref.util.setup_testing_defaults(e)
+            e['wsgi.input'] = stream(tob('x'*1000))
+            e['CONTENT_LENGTH'] = '1000'
+            request.bind(e, {'memfile_max': 100, 'body_chunk': 64})
+            self.assertEqual(None, request.body_view)
+            self.assertEqual(tob('x'*1000), request.body.read())
+            e['wsgi.input'] = stream(tob('abc'))
+            e['CONTENT_LENGTH'] = '3'
+            del e['bottle.body']
+            request.bind(e, {'memfile_max': 100})
+            self.assertEqual(tob('abc'), request.body_view.tobytes())
+            self.assertEqual(tob('abc'), request.body.read())
+
+    def test_body_read_buffer(self):
+        """ Environ: Small bodies are read without extra copies """
+        data = tob('x' * 100)
+        class Stream(object): # Like socket._fileobject: No readinto()
+            def __init__(self, parts): self.parts = parts
+            def read(self, size): return self.parts.pop(0) if self.parts else tob('')
+        self.assertTrue(bottle.read_buffer(Stream([data]), 100) is data)
+        parts = [tob('a'), tob('bc'), tob('d')]
+        self.assertEqual(tob('abc'), bottle.read_buffer(Stream(parts), 3))
+        self.assertEqual([tob('d')], parts)
+
+    def test_json(self):
+        """ Environ: Request.json decodes, caches and limits JSON bodies """
+        def bind(body, ctype='application/json; charset=UTF-8', config=None):
+            e = {}
+            wsgiref.util.setup_testing_defaults(e)
+            e['wsgi.input'] = StringIO(tob(body))
+            e['CONTENT_LENGTH'] = str(len(tob(body)))
+            e['CONTENT_TYPE'] = ctype
+            request.bind(e, config)
+            return e
+        e = bind('{"a": [1, 2]}')
+        self.assertEqual({'a': [1, 2]}, request.json)
+        self.assertTrue(request.json is e['bottle.json'])
+        request['wsgi.input'] = StringIO(tob('{"b": 1}'))
+        self.assertEqual({'b': 1}, request.json)
+        bind('{"a": 1}', 'text/plain')
+        self.assertEqual(None, request.json)
+        bind('')
+        self.assertEqual(None, request.json)
+        bind('{"a": ' + 'x'*1000 + '}')
+        self.assertRaises(bottle.HTTPError, lambda: request.json)
+        bind('{"a": 1}', config={'max_json_size': 5})
+        self.assertRaises(bottle.HTTPError, lambda: request.json)
+        bind('[' + '1,'*100000 + '1]', config={'memfile_max': 100})
+        self.assertEqual(100001, len(request.json))
+        bind('{"a": 1}', config={'json_loads': lambda s: 'custom'})
+        self.assertEqual('custom', request.json)
+
+    def test_stream(self):
+        """ Environ: Request.stream reads wsgi.input without buffering """
+        e = {}
+        wsgiref.util.setup_testing_defaults(e)
+        e['wsgi.input'].write((u'x'*1024*300).encode('utf8'))
+        e['wsgi.input'].seek(0)
+        e['CONTENT_LENGTH'] = str(1024*200)
+        request.bind(e, None)
+        blocks = list(request.stream)
+        self.assertTrue(len(blocks) > 1)
+        self.assertEqual(1024*200, len(tob('').join(blocks)))
+        self.assertEqual(tob(''), request.body.read())
+
+    def test_stream_buffered(self):
+        """ Environ: Request.stream reads from the buffer if present """
+        e = {}
+        wsgiref.util.setup_testing_defaults(e)
+        e['wsgi.input'].write(tob('abc'))
+        e['wsgi.input'].seek(0)
+        e['CONTENT_LENGTH'] = '3'
+        request.bind(e, None)
+        self.assertEqual(tob('abc'), request.body.read())
+        self.assertEqual(tob('abc'), tob('').join(request.stream))
+
     def test_bigbody(self):
         """ Environ: Request.body should handle big uploads using files """
         e = {}
@@ -237,5 +409,69 @@ class TestMultipart(unittest.TestCase):
         self.assertEqual(2, len(request.POST.getall('field2')))
         self.assertEqual(['value2', 'value3'], request.POST.getall('field2'))
 
+    def test_multipart_parser(self):
+        """ Environ: MultipartParser with small buffers and CRLF line endings """
+        body = '\r\n'.join(['preamble', '--foo',
+            'Content-Disposition: form-data; name="a"', '', 'value\r\n--fo',
+            '--foo',
+            'Content-Disposition: form-data; name="b"; filename="b.txt"',
+            'Content-Type: text/x-test', '', 'x' * 1000,
+            '--foo--', 'epilogue'])
+        for bufsize in (1, 7, 64, 2**16):
+            parser = bottle.MultipartParser(StringIO(body), 'foo',
+                         len(body), memfile_max=100, buffer_size=bufsize)
+            parts = list(parser)
+            self.assertEqual(['a', 'b'], [p.name for p in parts])
+            self.assertEqual('value\r\n--fo', parts[0].value)
+            self.assertEqual(None, parts[0].filename)
+            self.assertEqual('b.txt', parts[1].filename)
+            self.assertEqual('text/x-test', parts[1].type)
+            self.assertEqual('x' * 1000, parts[1].file.read())
+            self.assertTrue(hasattr(parts[1].file, 'fileno'))
+
+    def test_multipart_empty_file(self):
+        """ Environ: Empty file inputs (filename="") are form fields """
+        e = tools.multipart_environ([('a', 'x')], [('f', '', '')])
+        request.bind(e, None)
+        self.assertEqual('', request.forms['f'])
+        self.assertFalse('f' in request.files)
+
+    def test_multipart_broken(self):
+        """ Environ: MultipartParser rejects truncated bodies """
+        body = '--foo\r\nContent-Disposition: form-data; name="a"\r\n\r\nvalue'
+        parser = bottle.MultipartParser(StringIO(body), 'foo')
+        self.assertRaises(bottle.MultipartError, list, parser)
+
+    def test_limits(self):
+        """ Environ: Request size limits raise HTTPError(413) """
+        e = tools.multipart_environ([('a', 'x'*10), ('b', 'y')], [('f', 'f.txt', 'z'*100)])
+        request.bind(e, {'max_upload_size': 50})
+        self.assertRaises(bottle.HTTPError, lambda: request.POST)
+        for limits in ({'max_fields': 1}, {'max_field_size': 5},
+                       {'max_body_size': 100}):
+            request.bind(tools.multipart_environ([('a', 'x'*10), ('b', 'y')], []), limits)
+            self.assertRaises(bottle.HTTPError, lambda: request.POST)
+        e = {}
+        wsgiref.util.setup_testing_defaults(e)
+        e['wsgi.input'].write(tob('a=1&b=22&c=3'))
+        e['wsgi.input'].seek(0)
+        e['CONTENT_LENGTH'] = '12'
+        e['REQUEST_METHOD'] = 'POST'
+        request.bind(e, {'max_fields': 3, 'max_field_size': 2})
+        self.assertEqual('22', request.POST['b'])
+
+    def test_unknown_length(self):
+        """ Environ: Bodies without Content-Length need wsgi.input_terminated """
+        e = {}
+        wsgiref.util.setup_testing_defaults(e)
+        e['wsgi.input'].write(tob('abc'))
+        e['wsgi.input'].seek(0)
+        request.bind(e, None)
+        self.assertEqual(tob(''), request.body.read())
+        e = {'wsgi.input': StringIO('abc'), 'wsgi.input_terminated': True}
+        request.bind(e, {'max_body_size': 2})
+        self.assertRaises(bottle.HTTPError, lambda: request.body)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,7 @@
 import unittest
-from bottle import MultiDict, HeaderDict
+import os, shutil, tempfile
+from bottle import MemoryCacheStore, FileCacheStore
+from bottle import MultiDict, MultiDictView, HeaderDict, ResponseHeaders, LRUCache, MethodMap
 
 class TestMultiDict(unittest.TestCase):
     def test_isadict(self):
@@ -27,6 +29,24 @@ class TestMultiDict(unittest.TestCase):
         self.assertEqual([], m.getall('b'))
         self.assertEqual([('a', 5), ('a', 6)], list(m.iterallitems()))
    
+    def test_view(self):
+        """ MultiDictView layers MultiDicts without copying them """
+        a, b = MultiDict(x=1, y=2), MultiDict(y=3)
+        b['y'] = 4
+        v = MultiDictView(a, b)
+        self.assertEqual(4, v['y'])
+        self.assertEqual(1, v['x'])
+        self.assertEqual([2, 3, 4], v.getall('y'))
+        self.assertEqual(2, v.get('y', index=0))
+        self.assertEqual(None, v.get('z'))
+        self.assertRaises(KeyError, lambda: v['z'])
+        self.assertEqual(['x', 'y'], sorted(v.keys()))
+        self.assertEqual(2, len(v))
+        a['z'] = 5
+        self.assertEqual(5, v['z'])
+        self.assertEqual(5, len(list(v.iterallitems())))
+        self.assertRaises(TypeError, v.__setitem__, 'x', 1)
+
     def test_isheader(self):
         """ HeaderDict replaces by default and title()s its keys """
         m = HeaderDict(abc_def=5)
@@ -36,6 +56,26 @@ class TestMultiDict(unittest.TestCase):
         self.assertEqual(['6', '7'], m.getall('abc_def'))
         self.assertEqual([('Abc-Def', '6'), ('Abc-Def', '7')], list(m.iterallitems()))
     
+    def test_responseheaders(self):
+        """ ResponseHeaders behaves like HeaderDict """
+        m = ResponseHeaders(abc_def=5)
+        m['abc_def'] = 6
+        self.assertEqual(['6'], m.getall('ABC-DEF'))
+        m.append('abc_def', 7)
+        m.append('abc_def', 8)
+        self.assertEqual(['6', '7', '8'], m.getall('abc_def'))
+        self.assertEqual('8', m['Abc-Def'])
+        self.assertEqual('6', m.get('abc-def', index=0))
+        self.assertEqual(None, m.get('x'))
+        self.assertRaises(KeyError, lambda: m['x'])
+        c = m.copy()
+        c.append('abc_def', 9)
+        self.assertEqual(3, len(m.getall('abc_def')))
+        self.assertEqual([('Abc-Def', '6'), ('Abc-Def', '7'), ('Abc-Def', '8')],
+                         list(m.iterallitems()))
+        del m['abc-def']
+        self.assertFalse('Abc-Def' in m)
+
     def test_headergetbug(self):
         ''' Assure HeaderDict.get() to be case insensitive '''
         d = HeaderDict()
@@ -45,6 +85,97 @@ class TestMultiDict(unittest.TestCase):
         self.assertEqual(d.get('LOWER'), 'lower')
 
 
+class TestMethodMap(unittest.TestCase):
+    def test_fallbacks(self):
+        """ MethodMap resolves HEAD and ANY fallbacks """
+        m = MethodMap(GET='get', POST='post')
+        self.assertEqual('get', m['HEAD'])
+        self.assertEqual(None, m['PUT'])
+        self.assertEqual(None, m['OPTIONS'])
+        m = MethodMap(POST='post', ANY='any')
+        self.assertEqual('any', m['HEAD'])
+        self.assertEqual('any', m['OPTIONS'])
+        self.assertEqual('post', m['POST'])
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        """ LRUCache discards the least recently used item first """
+        c = LRUCache(2)
+        c['a'], c['b'] = 1, 2
+        self.assertEqual(1, c['a'])
+        c['c'] = 3
+        self.assertTrue('b' not in c)
+        self.assertEqual(['a', 'c'], sorted(c.keys()))
+        c['a'] = 4
+        c['d'] = 5
+        self.assertEqual(['a', 'd'], sorted(c.keys()))
+        del c['a']
+        self.assertEqual(1, len(c))
+        self.assertRaises(KeyError, lambda: c['a'])
+
+    def test_stats(self):
+        """ LRUCache counts hits and misses """
+        c = LRUCache(2)
+        c['a'] = 1
+        c.get('a'), c.get('a'), c.get('b')
+        self.assertEqual((2, 1), (c.hits, c.misses))
+
+
+    def test_maxbytes(self):
+        """ LRUCache can be bounded by the size of its values """
+        c = LRUCache(10, maxbytes=5)
+        c['a'], c['b'] = 'xx', 'yy'
+        c['a']
+        c['c'] = 'zz'
+        self.assertEqual(['a', 'c'], sorted(c.keys()))
+        c['c'] = 'z'
+        self.assertEqual(3, c.bytes)
+        c['d'] = 'dddddd'
+        self.assertEqual(0, len(c))
+
+
+class TestCacheStores(unittest.TestCase):
+    def check_store(self, store):
+        store.set('/a', ('/a', 1, 200, [('X', 'y')], 'a'*10))
+        store.set('/b', ('/b', 1, 200, [], 'b'))
+        self.assertEqual(('/a', 1, 200, [('X', 'y')], 'a'*10), tuple(store.get('/a')))
+        self.assertEqual(None, store.get('/c'))
+        store.set('/c', ('/c', 1, 200, [], 'c'))
+        self.assertEqual(None, store.get('/b'))
+        store.purge('/a')
+        self.assertEqual(None, store.get('/a'))
+        store.delete('/c')
+        self.assertEqual([], store.keys())
+
+    def test_memory(self):
+        """ MemoryCacheStore evicts and purges entries """
+        self.check_store(MemoryCacheStore(maxsize=2))
+
+    def test_file(self):
+        """ FileCacheStore evicts and purges entries """
+        path = tempfile.mkdtemp()
+        try:
+            self.check_store(FileCacheStore(path, maxsize=2))
+        finally:
+            shutil.rmtree(path)
+
+    def test_file_prune(self):
+        """ FileCacheStore scans its directory only when needed """
+        path = tempfile.mkdtemp()
+        try:
+            store = FileCacheStore(path, maxsize=3, prune_every=5)
+            scans = []
+            store._files = lambda f=store._files: scans.append(1) or f()
+            for i in range(3):
+                store.set('/%d' % i, ('/%d' % i, 1, 200, [], 'x'))
+            self.assertEqual(1, len(scans))
+            store.set('/3', ('/3', 1, 200, [], 'x')) # Over maxsize
+            self.assertEqual(2, len(scans))
+            self.assertEqual(3, len(os.listdir(path)))
+        finally:
+            shutil.rmtree(path)
+
    
 if __name__ == '__main__':
     unittest.main()
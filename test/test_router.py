@@ -1,5 +1,8 @@
 import unittest
 import bottle
+import os
+import tempfile
+import threading
 
 class TestRouter(unittest.TestCase):
     def setUp(self):
@@ -20,7 +23,7 @@ class TestRouter(unittest.TestCase):
         self.assertMatches('test', 'fullmatch', {'test': 'test'})
         add('/:#anon#/match', 'anon')
         self.assertMatches('/anon/match', 'anon')
-        self.assertFalse(match('//no/m/at/ch/'), "Expecting empty list of matches")
+        self.assertFalse(match('//no/m/at/ch/')[0], "Expecting no match")
         
 
     def testParentheses(self):
@@ -31,12 +34,68 @@ class TestRouter(unittest.TestCase):
         add('/func2(:param#(foo|bar)#)', 'func2')
         self.assertMatches('/func2(foo)', 'func2', {'param':'foo'})
         self.assertMatches('/func2(bar)', 'func2', {'param':'bar'})
-        self.assertFalse( match('/func2(baz)'), "Expecting empty list of matches") 
+        self.assertFalse(match('/func2(baz)')[0], "Expecting no match") 
         add('/groups/:param#(foo|bar)#', 'groups')
         self.assertMatches('/groups/foo', 'groups', {'param':'foo'})
 
     def testErrorInPattern(self):
-        self.assertRaises(bottle.RouteSyntaxError, self.r.add, '/:bug#(#/', 'buggy')
+        self.r.add('/:bug#(#/', 'buggy')
+        self.assertRaises(bottle.RouteSyntaxError, self.r.compile)
+
+    def testLazyCompile(self):
+        self.r.add('/:a/:b', 'handler')
+        self.assertEqual(None, self.r.routes[0]._tokens)
+        self.assertMatches('/a/b', 'handler', {'a': 'a', 'b': 'b'})
+
+    def testLazyRouteRegexp(self):
+        self.r.add('/x/:a#[0-9]+#', 'x')
+        self.r.add('/y/:a#[0-9]+#', 'y')
+        self.r.compile()
+        entries = [e for c, lookup in self.r.dynamic for e in lookup.values()]
+        self.assertEqual([None, None], [e[5] for e in entries])
+        self.assertMatches('/y/5', 'y', {'a': '5'})
+        self.assertEqual(1, len([e for e in entries if e[5]]))
+
+    def testConcurrentCompile(self):
+        for i in range(200):
+            self.r.add('/r%d/:a' % i, 'r%d' % i)
+        results = []
+        def worker():
+            results.append(self.r.match('/r199/x')[0])
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(8, len(results))
+        self.assertTrue(all(r and r['GET'] == 'r199' for r in results))
+
+    def testCacheFile(self):
+        fd, fname = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(fname)
+        try:
+            def fill(r):
+                r.add('/static', 'static')
+                r.add('/int/:i#int#', 'int')
+                r.add('/:a/:b#[0-9]+#', 'handler', name='named')
+                r.add('/tree/:a/:b', 'tree')
+                return r
+            fill(self.r).compile()
+            self.assertTrue(os.path.exists(fname) is False)
+            self.r = fill(self.r.__class__(cachefile=fname))
+            self.r.compile()
+            self.assertTrue(os.path.exists(fname))
+            self.r = fill(self.r.__class__(cachefile=fname))
+            self.r._build_table = None # Must not be called
+            self.assertMatches('/static', 'static')
+            self.assertMatches('/a/5', 'handler', {'a': 'a', 'b': '5'})
+            self.assertMatches('/int/5', 'int', {'i': 5})
+            self.assertMatches('/tree/x/y', 'tree', {'a': 'x', 'b': 'y'})
+            self.assertEqual('/a/5', self.r.build('named', a='a', b=5))
+            self.r = self.r.__class__(cachefile=fname)
+            self.r.add('/other', 'other') # Different routes -> rebuild table
+            self.assertMatches('/other', 'other')
+        finally:
+            if os.path.exists(fname): os.remove(fname)
 
     def testBuild(self):
         add = self.r.add
@@ -49,21 +108,136 @@ class TestRouter(unittest.TestCase):
         # RouteBuildError: No route found with name 'test'.
         self.assertRaises(bottle.RouteBuildError, build, 'testroute')
         # RouteBuildError: Missing parameter 'test' in route 'testroute'
-        #self.assertRaises(bottle.RouteBuildError, build, 'testroute', test='hello', name='1234')
+        self.assertRaises(bottle.RouteBuildError, build, 'testroute', test='hello', name='1234')
         # RouteBuildError: Parameter 'name' does not match pattern for route 'testroute': '[a-z]+'
-        #self.assertRaises(bottle.RouteBuildError, build, 'anonroute')
-        # RouteBuildError: Anonymous pattern found. Can't generate the route 'anonroute'.
-        
+        self.assertRaises(bottle.RouteBuildError, build, 'anonroute')
+        # RouteBuildError: Missing parameter 'anon0' in route 'anonroute'
+
+    def testBuildQuoting(self):
+        self.r.add('/:test/:path#path#', 'handler', name='quote')
+        url = self.r.build('quote', test='a b', path=u'\xe4/b')
+        self.assertEqual('/a%20b/%C3%A4/b', url)
+        self.assertRaises(bottle.RouteBuildError, self.r.build, 'quote', test='a/b', path='x')
+
+    def testBuildAll(self):
+        self.r.add('/item/:id#int#', 'handler', name='item')
+        urls = self.r.build_all('item', [dict(id=i) for i in range(3)])
+        self.assertEqual(['/item/0', '/item/1', '/item/2'], urls)
+        builder = self.r.builder('item')
+        self.assertEqual('/item/5', builder({'id': 5}))
+
+    def testCombined(self):
+        add = self.r.add
+        for i in range(300):
+            add('/route%d/:a/:b#[0-9]+#' % i, 'r%d' % i)
+        add('/groups/:a#(x|y)#/:b#(z)#', 'groups')
+        self.assertMatches('/route0/x/1', 'r0', {'a': 'x', 'b': '1'})
+        self.assertMatches('/route150/x/2', 'r150', {'a': 'x', 'b': '2'})
+        self.assertMatches('/route299/y/3', 'r299', {'a': 'y', 'b': '3'})
+        self.assertMatches('/groups/y/z', 'groups', {'a': 'y', 'b': 'z'})
+        self.assertEqual(4, len(self.r.dynamic)) # 99 routes per regexp
+        self.assertFalse(self.r.match('/route299/y/z')[0])
+
+    def testPriority(self):
+        add = self.r.add
+        add('/:a#.*#', 'catchall')
+        add('/:a#[0-9]+#', 'number')
+        self.assertMatches('/123', 'catchall')
+        add('/x/:a#[0-9]+#', 'high', priority=1)
+        add('/x/:a#.*#', 'low', priority=2)
+        self.assertMatches('/x/123', 'low')
+        add('/static', 'static')
+        self.assertMatches('/static', 'static')
+
+    def testOrder(self):
+        add = self.r.add
+        add('/p/:a/:b', 'wild')
+        add('/p/q/:b', 'static_segment')
+        add('/s/:a', 'tree')
+        add('/s/:a#.*#', 'high', priority=10)
+        add('/t/:a', 'low', priority=-1)
+        add('/t/:a#.*#', 'normal')
+        add('/u/:a#[0-9]+#', 'regexp')
+        add('/u/:a', 'later')
+        self.assertMatches('/p/q/1', 'wild', {'a': 'q', 'b': '1'})
+        self.assertMatches('/s/x', 'high', {'a': 'x'})
+        self.assertMatches('/t/x', 'normal', {'a': 'x'})
+        self.assertMatches('/u/1', 'regexp', {'a': '1'})
+        self.assertMatches('/u/x', 'later', {'a': 'x'})
+        add('/v/:a', 'first')
+        add('/v/:a', 'override', priority=-1)
+        add('/w/:a', 'first', priority=-1)
+        add('/w/:a', 'override')
+        self.assertMatches('/v/x', 'override', {'a': 'x'})
+        self.assertMatches('/w/x', 'override', {'a': 'x'})
+
+    def testMethod(self):
+        add = self.r.add
+        add('/foo', 'get_foo')
+        add('/:x', 'post_x', 'POST')
+        add('/n/:a#[0-9]+#', 'get_n')
+        add('/n/:a', 'post_n', 'POST')
+        add('/n/:a/x', 'get_x')
+        add('/n/:a#[a-z]+#/x', 'put_x', 'PUT')
+        self.assertEqual('post_x', self.r.match('/foo', 'POST')[0]['POST'])
+        self.assertEqual('get_foo', self.r.match('/foo', 'GET')[0]['GET'])
+        self.assertEqual(('post_n', {'a': '5'}),
+                         (self.r.match('/n/5', 'POST')[0]['POST'], self.r.match('/n/5', 'POST')[1]))
+        self.assertEqual('put_x', self.r.match('/n/b/x', 'PUT')[0]['PUT'])
+        targets, args = self.r.match('/n/5', 'PUT') # First match, for 405
+        self.assertEqual('get_n', targets['GET'])
+        self.assertEqual(['GET', 'HEAD', 'OPTIONS', 'POST'], self.r.allowed('/n/5'))
+        self.assertEqual(['GET', 'HEAD', 'OPTIONS', 'PUT'], self.r.allowed('/n/b/x'))
+        self.assertEqual(['GET', 'HEAD', 'OPTIONS', 'POST'], self.r.allowed('/foo'))
+
+    def testFilters(self):
+        add = self.r.add
+        add('/int/:id#int#', 'int', name='int')
+        add('/float/:ratio#float#', 'float')
+        add('/path/:p#path#', 'path', name='path')
+        self.assertMatches('/int/-5', 'int', {'id': -5})
+        self.assertTrue(isinstance(self.r.match('/int/5')[1]['id'], int))
+        self.assertFalse(self.r.match('/int/x')[0])
+        self.assertMatches('/float/0.5', 'float', {'ratio': 0.5})
+        self.assertMatches('/path/a/b/c', 'path', {'p': 'a/b/c'})
+        self.assertEqual('/int/5', self.r.build('int', id=5))
+        self.assertEqual('/path/a/b', self.r.build('path', p='a/b'))
+
+    def testCustomFilter(self):
+        bottle.Route.add_filter('hex', '[0-9a-f]+', lambda x: int(x, 16), lambda x: '%x' % x)
+        try:
+            self.r.add('/hex/:n#hex#', 'hex', name='hex')
+            self.assertMatches('/hex/ff', 'hex', {'n': 255})
+            self.assertEqual('/hex/10', self.r.build('hex', n=16))
+        finally:
+            del bottle.Route.filters['hex']
+
     def assertMatches(self, uri, handler_name, params={}, method='GET'):
-        match = self.r.match
-        expected_value = match(uri)
-        self.assertEquals(len(expected_value), 1)
-        tpl = expected_value[0].get(method)
-        self.assertTrue(tpl != None, "Method doesn't match")
-        self.assertEquals(handler_name, tpl[0])
+        targets, args = self.r.match(uri)
+        self.assertTrue(targets, "Expecting a match")
+        self.assertTrue(targets.get(method) != None, "Method doesn't match")
+        self.assertEquals(handler_name, targets[method])
         if params:
-            expected_params = tpl[1].match(uri).groupdict()
-            self.assertEquals(params, expected_params)
+            self.assertEquals(params, args)
+
+class TestRadixRouter(TestRouter):
+    def setUp(self):
+        self.r = bottle.RadixRouter()
+
+    def testTree(self):
+        add = self.r.add
+        add('/a/:x/c', 'wild')
+        add('/a/b/d', 'static')
+        add('/a/:x/:y/', 'trailing')
+        add('/a/:x/file.:ext', 'ext')
+        self.assertMatches('/a/b/c', 'wild', {'x': 'b'})
+        self.assertMatches('/a/b/d', 'static')
+        self.assertMatches('/a/b/e/', 'trailing', {'x': 'b', 'y': 'e'})
+        self.assertMatches('/a/b/file.txt', 'ext', {'x': 'b', 'ext': 'txt'})
+        self.assertFalse(self.r.match('/a//c')[0])
+        self.assertFalse(self.r.match('/a/b/e')[0])
+        self.assertEqual(1, len(self.r.dynamic)) # Only file.:ext needs a regexp
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -19,6 +19,21 @@ class TestSecureCookies(unittest.TestCase):
         self.assertTrue(bottle.cookie_is_encoded(cookie))
         self.assertFalse(bottle.cookie_is_encoded(tob('some string')))
 
+    def testKeyRotation(self):
+        old = bottle.cookie_encode(self.data, tob('old'))
+        signer = bottle.CookieSigner([tob('new'), tob('old')])
+        self.assertEqual(self.data, signer.decode(old))
+        self.assertEqual(self.data, bottle.cookie_decode(signer.encode(self.data), tob('new')))
+        self.assertEqual(None, bottle.cookie_decode(signer.encode(self.data), tob('old')))
+
+    def testCache(self):
+        signer = bottle.CookieSigner(self.key, cache=10)
+        cookie = signer.encode(self.data)
+        self.assertEqual(self.data, signer.decode(cookie))
+        self.assertEqual(self.data, signer.decode(cookie))
+        self.assertEqual(1, signer.cache.hits)
+        self.assertEqual(None, signer.decode(cookie[:-2] + tob('x')))
+
     def testWithBottle(self):
         bottle.app.push()
         bottle.response.bind(bottle.app())
@@ -26,6 +41,8 @@ class TestSecureCookies(unittest.TestCase):
         cheader = [v for k, v in bottle.response.wsgiheader() if k == 'Set-Cookie'][0]
         bottle.request.bind({'HTTP_COOKIE': cheader.split(';')[0]}, bottle.app())
         self.assertEqual(repr(dict(value=5)), repr(bottle.request.get_cookie('key', secret=tob('1234'))))
+        cookies = [v for k, v in bottle.response.wsgiheader() if k == 'Set-Cookie']
+        self.assertEqual([cheader], cookies)
         bottle.app.pop()
 
 if __name__ == '__main__':
@@ -59,6 +59,35 @@ class TestWsgi(ServerTestBase):
         self.assertBody('test3', '/any', method='POST')
         self.assertBody('test', '/any', method='DELETE')
 
+    def test_options(self):
+        """ WSGI: Automatic OPTIONS and Allow headers """
+        @bottle.route('/', method='GET;POST')
+        def test(): return 'test'
+        self.assertStatus(200, '/', method='OPTIONS')
+        self.assertHeader('Allow', 'GET, HEAD, OPTIONS, POST', '/', method='OPTIONS')
+        self.assertStatus(405, '/', method='PUT')
+        self.assertHeader('Allow', 'GET, HEAD, OPTIONS, POST', '/', method='PUT')
+        @bottle.route('/', method='OPTIONS')
+        def test2(): return 'options'
+        self.assertBody('options', '/', method='OPTIONS')
+
+    def test_method_fallthrough(self):
+        """ WSGI: Routes without a handler for the method are skipped """
+        @bottle.route('/foo')
+        def test(): return 'get'
+        @bottle.route('/:x', method='POST')
+        def test2(x): return 'post ' + x
+        @bottle.route('/n/:a#[0-9]+#')
+        def test3(a): return 'get ' + a
+        @bottle.route('/n/:a', method='POST')
+        def test4(a): return 'post ' + a
+        self.assertBody('get', '/foo')
+        self.assertBody('post foo', '/foo', post='x')
+        self.assertBody('post 5', '/n/5', post='x')
+        self.assertStatus(405, '/foo', method='PUT')
+        self.assertHeader('Allow', 'GET, HEAD, OPTIONS, POST', '/foo', method='PUT')
+        self.assertHeader('Allow', 'GET, HEAD, OPTIONS, POST', '/n/5', method='OPTIONS')
+
     def test_500(self):
         """ WSGI: Exceptions within handler code (HTTP 500) """
         @bottle.route('/')
@@ -123,6 +152,38 @@ class TestWsgi(ServerTestBase):
         self.assertTrue('b=b' in c)
         self.assertTrue('c=c; Path=/' in c)
 
+class TestMatchCache(ServerTestBase):
+    def setUp(self):
+        ServerTestBase.setUp(self)
+        self.app.match_cache = bottle.LRUCache(10)
+
+    def test_cache(self):
+        """ WSGI: Cached route lookups (including 404 and 405) """
+        @bottle.route('/item/:id')
+        def test(id): return id
+        self.assertBody('5', '/item/5')
+        self.assertBody('5', '/item/5')
+        self.assertStatus(404, '/nothing')
+        self.assertStatus(404, '/nothing')
+        self.assertStatus(405, '/item/5', method='POST')
+        self.assertStatus(405, '/item/5', method='POST')
+        self.assertHeader('Allow', 'GET, HEAD, OPTIONS', '/item/5', method='POST')
+        self.assertEqual(4, self.app.match_cache.hits)
+
+    def test_invalidate(self):
+        """ WSGI: Adding routes invalidates the route cache """
+        self.assertStatus(404, '/new')
+        @bottle.route('/new')
+        def test(): return 'new'
+        self.assertBody('new', '/new')
+
+
+@bottle.limit(max_body_size=5)
+def limited_handler():
+    """ Used by TestDecorators.test_lazy_handler """
+    return bottle.request.body.read()
+
+
 class TestDecorators(ServerTestBase):
     ''' Tests Decorators '''
 
@@ -157,12 +218,21 @@ class TestDecorators(ServerTestBase):
         self.assertStatus(200,'/5')
         self.assertBody('xxx', '/3')
 
+    def test_typed_params(self):
+        """ WSGI: Typed route wildcards """
+        @bottle.route('/:var#int#')
+        def test(var): return 'x' * var
+        self.assertStatus(404,'/noint')
+        self.assertBody('xxx', '/3')
+
     def test_routebuild(self):
         """ WSGI: Test validate-decorator"""
         @bottle.route('/a/:b/c', name='named')
         def test(var): pass
         self.assertEqual('/a/xxx/c', bottle.url('named', b='xxx'))
         self.assertEqual('/a/xxx/c', bottle.app().get_url('named', b='xxx'))
+        urls = bottle.app().get_urls('named', [dict(b='x'), dict(b='y')])
+        self.assertEqual(['/a/x/c', '/a/y/c'], urls)
 
     def test_decorators(self):
         app = bottle.Bottle()
@@ -178,6 +248,154 @@ class TestDecorators(ServerTestBase):
         bottle.delete('/d')('foo')
         self.assertEqual(app.routes, bottle.app().routes)
 
+    def test_lazy_handler(self):
+        """ WSGI: 'module:function' strings are imported on first request """
+        handler = bottle.route('/lazy/:s', callback='string:upper')
+        self.assertTrue(isinstance(handler, bottle.LazyHandler))
+        self.assertEqual(None, handler.func)
+        bottle.route('/broken', callback='no_such_module_:func')
+        self.assertBody('ABC', '/lazy/abc')
+        self.assertStatus(500, '/broken')
+        bottle.route('/lazy_limit', method='POST', callback='test_wsgi:limited_handler')
+        self.assertStatus(413, '/lazy_limit', post='x'*100)
+        self.assertBody('x', '/lazy_limit', post='x')
+        self.assertEqual(os.path.join, bottle.load('os.path:join'))
+        self.assertEqual(bottle.Bottle.route, bottle.load('bottle:Bottle.route'))
+
+    def test_limit(self):
+        """ WSGI: Oversized requests are rejected before the body is read """
+        bottle.app().config['max_body_size'] = 10
+        @bottle.route('/small', method='POST')
+        def small(): return bottle.request.body.read()
+        @bottle.route('/big', method='POST')
+        @bottle.limit(max_body_size=100)
+        def big(): return bottle.request.body.read()
+        self.assertBody('x'*10, '/small', post='x'*10)
+        self.assertStatus(413, '/small', post='x'*11)
+        self.assertBody('x'*100, '/big', post='x'*100)
+        self.assertStatus(413, '/big', post='x'*101)
+
+    def test_compress(self):
+        """ WSGI: Responses are compressed if enabled and accepted """
+        import zlib
+        text = 'x' * 1000
+        bottle.app().config['compress'] = True
+        bottle.route('/text')(lambda: text)
+        bottle.route('/short')(lambda: 'short')
+        bottle.route('/gen')(lambda: (text for i in range(3)))
+        @bottle.route('/image')
+        def image():
+            bottle.response.content_type = 'image/png'
+            return text
+        @bottle.route('/off')
+        @bottle.compress(False)
+        def off(): return text
+        gzip = {'HTTP_ACCEPT_ENCODING': 'deflate;q=0.5, gzip'}
+        result = self.urlopen('/text', env=gzip)
+        self.assertEqual('gzip', result['header']['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', result['header']['Vary'])
+        self.assertEqual(str(len(result['body'])), result['header']['Content-Length'])
+        self.assertEqual(text, zlib.decompress(result['body'], 16 + zlib.MAX_WBITS))
+        result = self.urlopen('/gen', env={'HTTP_ACCEPT_ENCODING': 'gzip;q=0, deflate'})
+        self.assertEqual('deflate', result['header']['Content-Encoding'])
+        self.assertEqual(text * 3, zlib.decompress(result['body']))
+        for path, env in (('/text', {}), ('/short', gzip), ('/image', gzip), ('/off', gzip)):
+            result = self.urlopen(path, env=dict(env))
+            self.assertFalse('Content-Encoding' in result['header'])
+
+    def test_etag(self):
+        """ WSGI: Weak ETags and If-None-Match """
+        bottle.app().config['etag'] = True
+        bottle.route('/text')(lambda: 'text')
+        result = self.urlopen('/text')
+        tag = result['header']['Etag']
+        self.assertTrue(tag.startswith('W/"'))
+        self.assertEqual(tag, self.urlopen('/text')['header']['Etag'])
+        result = self.urlopen('/text', env={'HTTP_IF_NONE_MATCH': '"x", ' + tag[2:]})
+        self.assertEqual(304, result['code'])
+        self.assertEqual(tob(''), result['body'])
+        self.assertStatus(200, '/text', env={'HTTP_IF_NONE_MATCH': '"x"'})
+
+    def test_etag_decorator(self):
+        """ WSGI: Precomputed ETags skip the handler """
+        calls = []
+        @bottle.route('/item/:id')
+        @bottle.etag(lambda id: 'v' + id)
+        def item(id):
+            calls.append(id)
+            return 'item'
+        self.assertEqual('W/"v1"', self.urlopen('/item/1')['header']['Etag'])
+        self.assertStatus(304, '/item/1', env={'HTTP_IF_NONE_MATCH': 'W/"v1"'})
+        self.assertStatus(304, '/item/1', env={'HTTP_IF_NONE_MATCH': '*'})
+        self.assertStatus(200, '/item/2', env={'HTTP_IF_NONE_MATCH': 'W/"v1"'})
+        self.assertEqual(['1', '2'], calls)
+
+    def test_cache(self):
+        """ WSGI: Cached responses skip the handler """
+        calls = []
+        @bottle.route('/cached')
+        @bottle.cache(ttl=60, vary=['Accept-Language'])
+        def cached():
+            calls.append(bottle.request.query_string)
+            bottle.response.headers['X-Test'] = 'yes'
+            return 'value %d' % len(calls)
+        @bottle.route('/cookie')
+        @bottle.cache()
+        def cookie():
+            calls.append('cookie')
+            bottle.response.set_cookie('a', 'b')
+            return 'cookie'
+        self.assertBody('value 1', '/cached')
+        result = self.urlopen('/cached')
+        self.assertEqual(tob('value 1'), result['body'])
+        self.assertEqual('yes', result['header']['X-Test'])
+        self.assertEqual('7', result['header']['Content-Length'])
+        self.assertBody('value 2', '/cached', env={'HTTP_ACCEPT_LANGUAGE': 'de'})
+        self.assertBody('value 2', '/cached', env={'HTTP_ACCEPT_LANGUAGE': 'de'})
+        bottle.app().cache_store.purge('/cached')
+        self.assertBody('value 3', '/cached')
+        self.assertBody('cookie', '/cookie')
+        self.assertBody('cookie', '/cookie')
+        self.assertEqual(5, len(calls))
+
+    def test_cache_headers(self):
+        """ WSGI: Cached responses keep repeated headers and ETags """
+        calls = []
+        @bottle.route('/links')
+        @bottle.cache()
+        @bottle.etag(lambda: 'v1')
+        def links():
+            calls.append(1)
+            bottle.response.headers.append('Link', '</a>; rel=a')
+            bottle.response.headers.append('Link', '</b>; rel=b')
+            return 'links'
+        for i in range(2):
+            result = self.urlopen('/links')
+            self.assertEqual('</a>; rel=a, </b>; rel=b', result['header']['Link'])
+            self.assertEqual('W/"v1"', result['header']['Etag'])
+        self.assertStatus(304, '/links', env={'HTTP_IF_NONE_MATCH': 'W/"v1"'})
+        self.assertEqual(1, len(calls))
+
+    def test_route_options_namespace(self):
+        """ WSGI: Unrelated handler attributes are not route options """
+        def memoize(func):
+            func.cache, func.limits, func.etag = {}, 'x', 'x'
+            return func
+        @bottle.route('/memo')
+        @bottle.compress(False)
+        @memoize
+        def memo(): return 'memo'
+        self.assertBody('memo', '/memo')
+        self.assertEqual({'compress': {'enable': False}}, memo._bottle_options)
+
+    def test_load_routes(self):
+        """ WSGI: Bulk route registration """
+        bottle.app().load_routes([('/a/:s', 'GET', 'string:upper'),
+                                  ('/b/:s', 'GET;POST', 'string:lower', {'name': 'b'})])
+        self.assertBody('X', '/a/x')
+        self.assertBody('x', '/b/X', post='y=z')
+        self.assertEqual('/b/x', bottle.url('b', s='x'))
+
     def test_autoroute(self):
         app = bottle.Bottle()
         def a(): pass
@@ -214,6 +432,25 @@ class TestAppMounting(ServerTestBase):
         self.assertStatus(200, '/test/test/bar')
         self.assertBody('bar', '/test/test/bar')
 
+    def test_script_name(self):
+        bottle.app().mount(self.subapp, '/test/sub')
+        @self.subapp.route('/:test')
+        def test(test):
+            return bottle.request['SCRIPT_NAME'] + '|' + bottle.request.path + '|' + test
+        self.assertBody('/test/sub|/foo|foo', '/test/sub/foo')
+        self.assertStatus(404, '/test/foo')
+
+    def test_flatten(self):
+        @self.subapp.route('/')
+        @self.subapp.route('/test/:test', name='subtest')
+        def test(test='foo'):
+            return test
+        bottle.app().mount(self.subapp, '/test', flatten=True)
+        self.assertStatus(404, '/test')
+        self.assertBody('foo', '/test/')
+        self.assertBody('bar', '/test/test/bar')
+        self.assertEqual('/test/test/x', bottle.url('subtest', test='x'))
+
 
     
 if __name__ == '__main__':